@@ -0,0 +1,83 @@
+import json
+import argparse
+import numpy as np
+from string import punctuation
+
+
+class AbbreviationIndex():
+    """
+    Abbreviated word -> full word, learned from the abbreviation counts (wordlist_raw) collected while labelling.
+
+    Persisted as two aligned arrays sorted by abbreviation (np.savez); loaded into a dict, so each lookup
+    is one hash of the word.
+    """
+
+    def __init__(self, keys, expansions):
+        self.keys = np.asarray(keys, dtype=str)
+        self.expansions = np.asarray(expansions, dtype=str)
+        self._lookup = dict(zip(self.keys.tolist(), self.expansions.tolist()))
+
+    def __len__(self):
+        return len(self._lookup)
+
+    @classmethod
+    def from_wordlist(cls, wordlist_raw, min_count=2, min_share=0.5):
+        """
+        Keep an abbreviation's most frequent full word if it was seen at least `min_count` times
+        and accounts for at least `min_share` of the abbreviation's occurrences.
+        Words that are themselves the full form of another abbreviation (e.g. "taman" for "tmn") are never expanded.
+        """
+        full_words = {full for counts in wordlist_raw.values() for full in counts}
+        keys, expansions = [], []
+        for short in sorted(wordlist_raw):
+            counts = wordlist_raw[short]
+            # a bare punctuation word strips to '' and can't be looked up
+            if short == '' or short in full_words:
+                continue
+            # ties go to the full word seen first, as dicts keep insertion order
+            full = max(counts, key=counts.get)
+            if counts[full] >= min_count and counts[full] >= min_share * sum(counts.values()):
+                keys.append(short)
+                expansions.append(full)
+        return cls(keys, expansions)
+
+    def save(self, path):
+        np.savez(path, keys=self.keys, expansions=self.expansions)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            return cls(arrays['keys'], arrays['expansions'])
+
+    def expand_word(self, word):
+        # same replacement the labelling applies to abbreviated words: punctuation around the word is kept
+        stripped = word.strip().strip(punctuation)
+        full = self._lookup.get(stripped)
+        return word if full is None else word.replace(stripped, full)
+
+    def expand_elements(self, elements):
+        """
+        Expand the abbreviated words of a batch of {"street", "poi"} in place; each distinct word is looked up once.
+        """
+        words = {word for element in elements for key in ("street", "poi") for word in element[key].split()}
+        expanded = {word: self.expand_word(word) for word in words}
+        for element in elements:
+            for key in ("street", "poi"):
+                element[key] = " ".join(expanded[word] for word in element[key].split())
+        return elements
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Build the abbreviation index from the counts written by labelling.py --wordlist')
+    parser.add_argument('--wordlist', required=True, help='json {abbreviated word: {full word: count}}')
+    parser.add_argument('--output', required=True, help='index file (.npz); put it in the model directory as abbreviations.npz for pred.py')
+    parser.add_argument('--min_count', type=int, default=2, help='ignore expansions seen fewer times')
+    parser.add_argument('--min_share', type=float, default=0.5, help='ignore expansions that are not this share of the abbreviation\'s uses')
+    args = parser.parse_args()
+
+    with open(args.wordlist) as f:
+        wordlist_raw = json.load(f)
+    index = AbbreviationIndex.from_wordlist(wordlist_raw, args.min_count, args.min_share)
+    index.save(args.output)
+    print(f"{len(index)} of {len(wordlist_raw)} abbreviations kept, written to {args.output}")
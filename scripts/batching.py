@@ -0,0 +1,133 @@
+import numpy as np
+
+
+def fixed_batches(n_rows, batch_size):
+    """
+    Row indices of consecutive fixed-size batches, in file order.
+    """
+    return [np.arange(start, min(start + batch_size, n_rows)) for start in range(0, n_rows, batch_size)]
+
+
+def length_bucketed_batches(lengths, max_tokens, max_rows=None):
+    """
+    Group rows of similar sub-word length so each batch pads to little more than its own rows.
+
+    Args:
+        - lengths: sub-word length (incl. special tokens) of every row
+        - max_tokens: budget for a padded batch, i.e. rows * longest row. A row longer than the budget gets its own batch.
+        - max_rows: optional cap on rows per batch
+
+    Returns:
+        list of row index arrays; rows are sorted by length so callers must write results back by index.
+    """
+    lengths = np.asarray(lengths)
+    order = np.argsort(lengths, kind='stable')
+
+    batches = []
+    start = 0
+    for end in range(1, len(order) + 1):
+        # rows are sorted, so the row just added is the longest of the batch
+        n_rows = end - start
+        too_many_tokens = n_rows * lengths[order[end - 1]] > max_tokens
+        too_many_rows = max_rows is not None and n_rows > max_rows
+        if (too_many_tokens or too_many_rows) and n_rows > 1:
+            batches.append(order[start:end - 1])
+            start = end - 1
+    if start < len(order):
+        batches.append(order[start:])
+    return batches
+
+
+def padding_efficiency(lengths, batches):
+    """
+    Share of real (non-padding) tokens in the padded batches.
+    """
+    lengths = np.asarray(lengths)
+    padded = sum(len(batch_idx) * lengths[batch_idx].max() for batch_idx in batches if len(batch_idx) > 0)
+    return lengths.sum() / padded if padded > 0 else 1.0
+
+
+# padded lengths used for the exported serving graph, so only a handful of input shapes ever reach it
+SEQ_BUCKETS = (16, 32, 64, 128, 256, 512)
+
+def bucket_length(length, buckets=SEQ_BUCKETS):
+    for bucket in buckets:
+        if length <= bucket:
+            return bucket
+    return length
+
+def pad_rows(rows, pad_value, length, dtype=np.int32):
+    """
+    Right-pad ragged rows into a (len(rows), length) matrix.
+    """
+    padded = np.full((len(rows), length), pad_value, dtype=dtype)
+    for i, row in enumerate(rows):
+        padded[i, :len(row)] = row
+    return padded
+
+
+def word_aligned_windows(word_ids, max_content, overlap):
+    """
+    Split one address's sub-words into overlapping windows of at most `max_content` sub-words.
+
+    Windows end at a word boundary, unless a single word is longer than a window, and each window
+    starts at the first word boundary within the last `overlap` sub-words of the previous one.
+
+    Args:
+        - word_ids: word id of every sub-word, special tokens excluded
+        - max_content: sub-words per window, i.e. the model's max length minus the special tokens
+        - overlap: sub-words of context shared by consecutive windows; must be smaller than max_content
+
+    Returns:
+        list of (start, end) sub-word ranges covering every sub-word.
+    """
+    n = len(word_ids)
+    if n <= max_content:
+        return [(0, n)]
+    word_ids = np.asarray(word_ids)
+    word_starts = np.flatnonzero(np.r_[True, word_ids[1:] != word_ids[:-1]])
+
+    windows = []
+    start = 0
+    while start + max_content < n:
+        # last word boundary inside the window, or a cut through a word longer than the window
+        limit = start + max_content
+        i = np.searchsorted(word_starts, limit, side='right') - 1
+        end = int(word_starts[i]) if word_starts[i] > start else limit
+        windows.append((start, end))
+        # first word boundary in the overlap; if there is none, the next window starts where this one ended
+        j = np.searchsorted(word_starts, max(end - overlap, start + 1))
+        next_start = int(word_starts[j]) if j < len(word_starts) and word_starts[j] < end else end
+        # drop the overlap if it leaves no room for a whole new word in the next window
+        if next_start < end and next_start + max_content < n:
+            k = np.searchsorted(word_starts, next_start + max_content, side='right') - 1
+            if word_starts[k] <= end:
+                next_start = end
+        start = next_start
+    windows.append((start, n))
+    return windows
+
+
+def window_rows(input_ids, batch_wordid, max_length, overlap):
+    """
+    Cut rows longer than `max_length` into word-aligned overlapping windows (see word_aligned_windows).
+
+    Rows must be `tokenizer(...)` outputs with one special token at each end, and batch_wordid their word ids
+    (-1 for special tokens). Every window gets the row's first and last token back around it.
+
+    Returns:
+        (input_ids, word ids, row) of every window; row is the index of the row each window came from.
+        Rows that fit are passed through as one window.
+    """
+    window_ids, window_wordid, window_row = [], [], []
+    for row, (ids, wordid) in enumerate(zip(input_ids, batch_wordid)):
+        if len(ids) <= max_length:
+            window_ids.append(ids)
+            window_wordid.append(wordid)
+            window_row.append(row)
+            continue
+        for start, end in word_aligned_windows(wordid[1:-1], max_length - 2, overlap):
+            window_ids.append([ids[0]] + list(ids[1 + start:1 + end]) + [ids[-1]])
+            window_wordid.append([-1] + list(wordid[1 + start:1 + end]) + [-1])
+            window_row.append(row)
+    return window_ids, window_wordid, np.array(window_row, dtype=np.int64)
@@ -0,0 +1,42 @@
+import time
+import argparse
+import pandas as pd
+from abbreviations import AbbreviationIndex
+
+
+def expand_in_batches(index, elements, batch_size):
+    for start in range(0, len(elements), batch_size):
+        index.expand_elements(elements[start:start + batch_size])
+    return elements
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Time abbreviation expansion on extracted elements')
+    parser.add_argument('--index', required=True, help='abbreviations.npz written by abbreviations.py')
+    parser.add_argument('--input', default='../data/pred.csv', help='predictions csv with columns id, POI/street')
+    parser.add_argument('--batch_size', type=int, default=512, help='addresses per expand_elements call, as in pred.py')
+    parser.add_argument('--repeat', type=int, default=5, help='runs, the best is reported')
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    index = AbbreviationIndex.load(args.index)
+    load_time = time.perf_counter() - start_time
+
+    poi_street = pd.read_csv(args.input, dtype={'POI/street': str}, keep_default_na=False)['POI/street']
+    parts = poi_street.str.split('/', n=1)
+    original = [{"poi": p[0], "street": p[1] if len(p) > 1 else ""} for p in parts]
+
+    times = []
+    for _ in range(args.repeat):
+        elements = [dict(e) for e in original]
+        start_time = time.perf_counter()
+        expand_in_batches(index, elements, args.batch_size)
+        times.append(time.perf_counter() - start_time)
+
+    changed = sum(e != o for e, o in zip(elements, original))
+    print(f"index: {len(index)} abbreviations, loaded in {load_time * 1e3:.1f} ms")
+    print(f"{len(original)} addresses, {changed} ({changed / len(original):.1%}) changed by expansion")
+    print(f"expansion: {min(times) / len(original) * 1e4 * 1e3:.1f} ms per 10k addresses")
+    for e, o in [(e, o) for e, o in zip(elements, original) if e != o][:5]:
+        print(f"  {o['poi']}/{o['street']}  ->  {e['poi']}/{e['street']}")
@@ -0,0 +1,45 @@
+import re, time
+import argparse
+import pandas as pd
+from cleaning import clean, clean_series, make_cached_clean
+
+
+# the original four-pass cleaner, kept here as the reference for output and speed
+def clean_reference(s):
+    res = re.sub(r'(\w)(\()(\w)', r'\g<1> \g<2>\g<3>', s)
+    res = re.sub(r'(\w)([),.:;]+)(\w)', r'\g<1>\g<2> \g<3>', res)
+    res = re.sub(r'(\w)(\.\()(\w)', r'\g<1>. (\g<3>', res)
+    res = re.sub(r'\s+', ' ', res)
+    res = res.strip()
+    return res
+
+def best_of(fn, repeat): 
+    times = []
+    for _ in range(repeat): 
+        start_time = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start_time)
+    return min(times), result
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Microbenchmark the address cleaner against the original implementation')
+    parser.add_argument('--input', default='../data/test.csv', help='csv with a raw_address column')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per variant, the best is reported')
+    args = parser.parse_args()
+
+    raw_address = pd.read_csv(args.input, dtype={'raw_address': str}, keep_default_na=False)['raw_address']
+    print(f"{len(raw_address)} addresses, {raw_address.nunique()} distinct")
+
+    reference_time, reference = best_of(lambda: raw_address.apply(clean_reference), args.repeat)
+    variants = {
+        "clean (.apply)": lambda: raw_address.apply(clean),
+        "clean_series": lambda: clean_series(raw_address),
+        "cached clean (.apply, cold)": lambda: raw_address.apply(make_cached_clean()),
+    }
+    print(f"{'reference (.apply)':<28} {reference_time * 1e3:8.1f} ms")
+    for name, fn in variants.items(): 
+        elapsed, result = best_of(fn, args.repeat)
+        assert result.tolist() == reference.tolist(), f"{name} output differs from the reference cleaner"
+        print(f"{name:<28} {elapsed * 1e3:8.1f} ms  {reference_time / elapsed:5.2f}x")
@@ -0,0 +1,136 @@
+import os, json, time, resource, tempfile, subprocess
+import argparse
+from collections import Counter
+import logging
+import pandas as pd
+from pred import AddressElementExtract, set_global_logging_level
+from instrumentation import PipelineMetrics
+
+# End-to-end throughput of the extraction pipeline, stage by stage, on data/test.csv.
+# The model is a tiny randomly initialised BERT and, unless --tokenizer is given, the WordPiece vocabulary is built
+# from the addresses themselves, so the benchmark runs offline on CPU and only measures the pipeline's own cost.
+# The timed code is AddressElementExtract itself, with the stage names of its PipelineMetrics.
+STAGES = ['clean', 'cache', 'tokenize', 'batching', 'pad', 'forward', 'argmax', 'masking', 'compress_recon',
+          'expand_abbreviations', 'csv_write']
+
+
+def build_vocab(words, vocab_size):
+    # special tokens, every character as a word start and a continuation, then the most frequent words
+    chars = sorted({c for word in words for c in word})
+    frequent = [word for word, _ in Counter(words).most_common() if len(word) > 1]
+    vocab = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + chars + ['##' + c for c in chars]
+    return vocab + frequent[:max(0, vocab_size - len(vocab))]
+
+
+def offline_tokenizer(texts, vocab_size, vocab_dir):
+    from transformers import BertTokenizerFast
+    vocab = build_vocab([word for text in texts for word in text.lower().split()], vocab_size)
+    vocab_file = os.path.join(vocab_dir, "vocab.txt")
+    with open(vocab_file, 'w', encoding='utf-8') as f:
+        f.write("\n".join(vocab) + "\n")
+    return BertTokenizerFast(vocab_file=vocab_file, do_lower_case=True)
+
+
+def tiny_model(vocab_size, hidden_size, num_layers, seed):
+    import tensorflow as tf
+    from transformers import BertConfig, TFAutoModelForTokenClassification
+    from finetune_bert import tag2index, index2tag
+    tf.random.set_seed(seed)
+    config = BertConfig(vocab_size=vocab_size, hidden_size=hidden_size, num_hidden_layers=num_layers,
+                        num_attention_heads=max(1, hidden_size // 32), intermediate_size=4 * hidden_size,
+                        id2label=index2tag, label2id=tag2index)
+    model = TFAutoModelForTokenClassification.from_config(config)
+    # create the weights, so the model can be saved before it has seen any input
+    model(model.dummy_inputs)
+    return model
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_pipeline(extractor, raw_texts, ids, output_path, batch_size, max_tokens, metrics):
+    """
+    AddressElementExtract.extract_elements plus pred_test.py's csv write; stage times go to `metrics`,
+    which must be the extractor's own PipelineMetrics. Returns the number of rows written.
+    """
+    elements = extractor.extract_elements(raw_texts, batch_size, max_tokens)
+    with metrics.stage('csv_write'):
+        pd.DataFrame({'id': ids, 'POI/street': [e['poi'] + "/" + e['street'] for e in elements]}).to_csv(output_path, index=False)
+    return len(elements)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark every stage of the extraction pipeline offline on CPU, written as JSON')
+    parser.add_argument('--input', default='../data/test.csv', help='csv with columns id, raw_address')
+    parser.add_argument('--output', default='bench_pipeline.json', help='JSON results file')
+    parser.add_argument('--max_rows', type=int, default=None, help='only use the first rows of the input')
+    parser.add_argument('--batch_size', type=int, default=512)
+    parser.add_argument('--max_tokens', type=int, default=None, help='batch rows of similar length under this padded-token budget')
+    parser.add_argument('--max_length', type=int, default=None, help='cut longer addresses into windows of this many sub-words')
+    parser.add_argument('--window_overlap', type=int, default=16, help='sub-words shared by consecutive windows')
+    parser.add_argument('--tokenizer', default=None, help='local tokenizer directory; default: a vocabulary built from the input')
+    parser.add_argument('--vocab_size', type=int, default=8000, help='size of the vocabulary built from the input')
+    parser.add_argument('--hidden_size', type=int, default=64, help='hidden size of the random BERT')
+    parser.add_argument('--num_layers', type=int, default=2, help='layers of the random BERT')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    df = pd.read_csv(args.input, nrows=args.max_rows, dtype={'raw_address': str}, keep_default_na=False)
+    raw_texts = df['raw_address'].tolist()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.tokenizer is not None:
+            from transformers import AutoTokenizer
+            tokenizer = AutoTokenizer.from_pretrained(args.tokenizer, local_files_only=True)
+        else:
+            tokenizer = offline_tokenizer(raw_texts, args.vocab_size, tmp_dir)
+        model = tiny_model(len(tokenizer), args.hidden_size, args.num_layers, args.seed)
+        # a model directory like finetune_bert.py's, for the extractor to load
+        model_dir = os.path.join(tmp_dir, "model")
+        model.save_pretrained(model_dir)
+        tokenizer.save_pretrained(model_dir)
+
+        timer = PipelineMetrics()
+        # warmup builds and traces the model without touching the metrics
+        extractor = AddressElementExtract(model_dir, use_saved_model=False, warmup=True, metrics=timer,
+                                          max_length=args.max_length, window_overlap=args.window_overlap)
+        set_global_logging_level(logging.ERROR)
+
+        start_time = time.perf_counter()
+        n_rows = run_pipeline(extractor, raw_texts, df['id'].values, os.path.join(tmp_dir, "pred.csv"),
+                              args.batch_size, args.max_tokens, timer)
+        total = time.perf_counter() - start_time
+
+    staged = sum(timer.stage_seconds.values())
+    # stages the extractor's configuration skipped (e.g. expand_abbreviations) are left out
+    stages = [name for name in STAGES if name in timer.stage_seconds]
+    results = {
+        "commit": git_commit(),
+        "input": args.input,
+        "rows": n_rows,
+        "batch_size": args.batch_size,
+        "max_tokens": args.max_tokens,
+        "max_length": extractor.max_length,
+        "window_overlap": args.window_overlap,
+        "model": {"vocab_size": len(tokenizer), "hidden_size": args.hidden_size, "num_layers": args.num_layers},
+        "total_seconds": total,
+        "rows_per_sec": n_rows / total,
+        "stages": {name: {"seconds": timer.stage_seconds[name], "share": timer.stage_seconds[name] / staged if staged > 0 else 0.0,
+                          "rows_per_sec": n_rows / timer.stage_seconds[name] if timer.stage_seconds[name] > 0 else None}
+                   for name in stages},
+        "counters": dict(timer.counters),
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    for name in stages:
+        print(f"{name:<16} {timer.stage_seconds[name]:8.3f}s  {results['stages'][name]['share']:6.1%}")
+    print(f"{n_rows} rows in {total:.2f}s: {results['rows_per_sec']:.1f} rows/sec, peak RSS {results['peak_rss_mb']:.0f} MB")
+    print(f"results written to {args.output}")
@@ -0,0 +1,33 @@
+import time
+import argparse
+import pandas as pd
+from pred import AddressElementExtract
+
+
+# time extract_elements through Keras model.predict and through the exported SavedModel on the same rows
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Compare the SavedModel serving path against the Keras model.predict loop')
+    parser.add_argument('--model_dir', required=True, help='fine-tuned model directory with a saved_model/ from export_savedmodel.py')
+    parser.add_argument('--input', default="../data/test.csv", help='csv with a raw_address column')
+    parser.add_argument('--rows', type=int, default=5000, help='rows of the csv to run')
+    parser.add_argument('--batch_size', type=int, default=512)
+    parser.add_argument('--max_tokens', type=int, default=None, help='bucket batches by length under this token budget')
+    args = parser.parse_args()
+
+    raw_texts = pd.read_csv(args.input, dtype={'raw_address': str}, keep_default_na=False)['raw_address'].tolist()[:args.rows]
+
+    results = {}
+    for name, use_saved_model in [("keras model.predict", False), ("saved_model signature", True)]: 
+        extractor = AddressElementExtract(args.model_dir, clean_cache_size=0, use_saved_model=use_saved_model)
+        if use_saved_model and extractor.serving_fn is None: 
+            raise SystemExit(f"no saved_model/ exported from the current tf_model.h5 in {args.model_dir}; run export_savedmodel.py first")
+        extractor.warmup()
+        start_time = time.perf_counter()
+        results[name] = extractor.extract_elements(raw_texts, batch_size=args.batch_size, max_tokens=args.max_tokens)
+        elapsed = time.perf_counter() - start_time
+        print(f"{name:<24} {elapsed:7.2f}s  {len(raw_texts) / elapsed:8.1f} rows/sec")
+
+    keras_results, saved_model_results = results.values()
+    n_diff = sum(a != b for a, b in zip(keras_results, saved_model_results))
+    print(f"{n_diff} of {len(raw_texts)} rows differ between the two paths")
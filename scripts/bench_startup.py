@@ -0,0 +1,39 @@
+import time
+start_time = time.perf_counter()
+
+import json
+import argparse
+
+
+# run in a fresh process: every stage of a cold start is timed, from the first import to the first extraction
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Break down cold-start time of AddressElementExtract')
+    parser.add_argument('--model_dir', required=True, help='fine-tuned model directory or exported bundle')
+    parser.add_argument('--address', default="jalan tipar cakung no 26 depan rusun albo garasi dumtruk", help='address for the first inferences')
+    args = parser.parse_args()
+
+    timings = {}
+    def lap(name): 
+        global start_time
+        now = time.perf_counter()
+        timings[name] = now - start_time
+        start_time = now
+
+    import pred
+    lap("import pred")
+    import tensorflow, transformers
+    lap("import tensorflow + transformers")
+    extractor = pred.AddressElementExtract(args.model_dir)
+    lap("load tokenizer + model")
+    extractor.warmup()
+    lap("warm-up")
+    extractor.extract_elements([args.address])
+    lap("first inference")
+    extractor.extract_elements([args.address])
+    lap("second inference")
+
+    for name, seconds in timings.items(): 
+        print(f"{name:<34} {seconds:7.3f}s")
+    print(f"{'total':<34} {sum(timings.values()):7.3f}s")
+    print(json.dumps(timings))
@@ -0,0 +1,74 @@
+import re
+from functools import lru_cache
+
+# One pass over the three spacing rules of the original cleaner:
+#   rule 0: "a(b"  -> "a (b"
+#   rule 1: "a.,b" -> "a., b"   (any run of ),.:; between two word characters)
+#   rule 2: "a.(b" -> "a. (b"
+# The original ran one re.sub per rule, and each re.sub consumed the word characters on both
+# sides of a match, so e.g. "a(b(c" -> "a (b(c". Lookarounds find every candidate without
+# consuming, and _space_punct replays that consumption per rule to stay byte-identical.
+_PUNCT_RE = re.compile(r'(?<=\w)(?:\.?\(|[),.:;]+)(?=\w)')
+_PUNCT_CHARS = frozenset('(),.:;')
+
+
+def _space_punct(s):
+    last_end = [0, 0, 0]  # end of the last match of each rule, as the original re.sub would see it
+
+    def repl(m):
+        start, end = m.span()
+        text = m.group()
+        if text[-1] == '(':
+            rule = 0 if len(text) == 1 else 2
+        else:
+            rule = 1
+        # the word character before this match was already eaten by the previous match of the same rule
+        if start - 1 < last_end[rule]:
+            return text
+        last_end[rule] = end + 1
+        if rule == 0:
+            return ' ('
+        elif rule == 2:
+            return '. ('
+        return text + ' '
+
+    return _PUNCT_RE.sub(repl, s)
+
+
+# for data cleaning: space out brackets and punctuation stuck between words, collapse whitespace
+def clean(s):
+    if not _PUNCT_CHARS.isdisjoint(s):
+        s = _space_punct(s)
+    # str.split() splits on exactly the characters \s matches, so this is re.sub(r'\s+', ' ', s).strip()
+    return " ".join(s.split())
+
+
+def make_cached_clean(maxsize=65536):
+    """
+    clean with a bounded LRU cache keyed on the raw text, for traffic where the same addresses repeat.
+    """
+    return lru_cache(maxsize=maxsize)(clean)
+
+
+def clean_many(texts, clean_fn=clean):
+    """
+    Clean a list of strings, running `clean_fn` once per distinct string.
+    """
+    cleaned = {}
+    for s in texts:
+        if s not in cleaned:
+            cleaned[s] = clean_fn(s)
+    return [cleaned[s] for s in texts]
+
+
+def clean_series(series, clean_fn=clean):
+    """
+    Bulk entry point for a pandas string column (an Arrow column can be passed as `column.to_pandas()`).
+    Distinct values are factorized out and cleaned once, then broadcast back to every row.
+    """
+    import pandas as pd
+    codes, uniques = pd.factorize(series)
+    if (codes < 0).any():
+        raise TypeError("clean_series expects a column of strings, got missing values")
+    cleaned = pd.Index([clean_fn(s) for s in uniques], dtype=object)
+    return pd.Series(cleaned.take(codes), index=series.index, name=series.name)
@@ -0,0 +1,119 @@
+from transformers import AutoTokenizer, BertConfig, TFAutoModelForTokenClassification, create_optimizer
+import tensorflow as tf
+import argparse, os
+from finetune_bert import tag2index, index2tag
+from pretokenize import load_or_build_cache, to_tf_dataset
+
+
+# token-level loss of the student: soft teacher targets plus gold IOBES labels, padding/special tokens (-100) ignored
+def distillation_loss(student_logits, teacher_logits, labels, alpha=0.5, temperature=2.0):
+    mask = tf.cast(tf.not_equal(labels, -100), student_logits.dtype)
+    n_tokens = tf.maximum(tf.reduce_sum(mask), 1.0)
+
+    # KL(teacher || student) on temperature-softened distributions, scaled by T^2 to keep gradient size comparable
+    teacher_probs = tf.nn.softmax(teacher_logits / temperature, axis=-1)
+    student_log_probs = tf.nn.log_softmax(student_logits / temperature, axis=-1)
+    teacher_log_probs = tf.nn.log_softmax(teacher_logits / temperature, axis=-1)
+    soft = tf.reduce_sum(teacher_probs * (teacher_log_probs - student_log_probs), axis=-1)
+    soft_loss = tf.reduce_sum(soft * mask) / n_tokens * temperature ** 2
+
+    hard = tf.keras.losses.sparse_categorical_crossentropy(tf.maximum(labels, 0), student_logits, from_logits=True)
+    hard_loss = tf.reduce_sum(hard * mask) / n_tokens
+
+    return alpha * soft_loss + (1 - alpha) * hard_loss
+
+
+class Distiller(tf.keras.Model):
+    """
+    Trains `student` on the logits of a frozen `teacher` plus the gold labels; only the student is updated.
+    """
+
+    def __init__(self, student, teacher, alpha=0.5, temperature=2.0):
+        super().__init__()
+        self.student = student
+        self.teacher = teacher
+        self.teacher.trainable = False
+        self.alpha = alpha
+        self.temperature = temperature
+
+    def call(self, inputs, training=False):
+        return self.student(inputs, training=training)
+
+    def _loss(self, data, training):
+        inputs = {k: v for k, v in data.items() if k != 'labels'}
+        teacher_logits = self.teacher(inputs, training=False).logits
+        student_logits = self.student(inputs, training=training).logits
+        return distillation_loss(student_logits, teacher_logits, data['labels'], self.alpha, self.temperature)
+
+    def train_step(self, data):
+        with tf.GradientTape() as tape:
+            loss = self._loss(data, training=True)
+        gradients = tape.gradient(loss, self.student.trainable_variables)
+        self.optimizer.apply_gradients(zip(gradients, self.student.trainable_variables))
+        return {"loss": loss}
+
+    def test_step(self, data):
+        return {"loss": self._loss(data, training=False)}
+
+
+def student_config(teacher_config, num_layers, hidden_size, num_heads, intermediate_size):
+    # same vocabulary and label map as the teacher, so the student drops into the prediction scripts
+    config = BertConfig.from_dict(teacher_config.to_dict())
+    config.num_hidden_layers = num_layers
+    config.hidden_size = hidden_size
+    config.num_attention_heads = num_heads
+    config.intermediate_size = intermediate_size
+    config.id2label = index2tag
+    config.label2id = tag2index
+    return config
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Distil the fine-tuned BERT into a small student token classifier')
+    parser.add_argument('--data_csv', default="train_df_pretokenization.csv", help='labelled csv written by the preprocessing step')
+    parser.add_argument('--teacher_dir', required=True, help='directory holding the fine-tuned config.json and tf_model.h5')
+    parser.add_argument('--tokenizer', default="indobenchmark/indobert-base-p2", help='hub id or local directory of the tokenizer')
+    parser.add_argument('--output', required=True, help='directory for the student (config.json, tf_model.h5 and tokenizer)')
+    parser.add_argument('--num_layers', type=int, default=4)
+    parser.add_argument('--hidden_size', type=int, default=384)
+    parser.add_argument('--num_heads', type=int, default=6)
+    parser.add_argument('--intermediate_size', type=int, default=1536)
+    parser.add_argument('--alpha', type=float, default=0.5, help='weight of the soft teacher loss; 1 - alpha goes to the gold labels')
+    parser.add_argument('--temperature', type=float, default=2.0)
+    parser.add_argument('--epochs', type=int, default=5)
+    parser.add_argument('--batch_size', type=int, default=128)
+    parser.add_argument('--learning_rate', type=float, default=1e-4)
+    parser.add_argument('--cache_dir', default="pretokenized", help='pre-tokenized dataset written by pretokenize.py (built if missing or stale)')
+    parser.add_argument('--max_rows', type=int, default=None, help='only use the first rows of each split, e.g. for a quick CPU run')
+    args = parser.parse_args()
+
+    # same pre-tokenized dataset and split as finetune_bert.py
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    meta, arrays = load_or_build_cache(args.data_csv, tokenizer, args.cache_dir)
+    if args.max_rows is not None: 
+        arrays = dict(arrays, train_rows=arrays['train_rows'][:args.max_rows], test_rows=arrays['test_rows'][:args.max_rows])
+    tf_train_dataset, tf_val_dataset = [to_tf_dataset(arrays, split, args.batch_size, tokenizer.pad_token_id) 
+                                        for split in ['train', 'test']]
+
+    # teacher: the fine-tuned model; student: a randomly initialised small BERT
+    teacher_config = BertConfig.from_json_file(os.path.join(args.teacher_dir,"config.json"))
+    teacher = TFAutoModelForTokenClassification.from_pretrained(os.path.join(args.teacher_dir,"tf_model.h5"), config = teacher_config)
+    student = TFAutoModelForTokenClassification.from_config(
+        student_config(teacher_config, args.num_layers, args.hidden_size, args.num_heads, args.intermediate_size))
+
+    optimizer, lr_schedule = create_optimizer(
+        init_lr=args.learning_rate,
+        num_train_steps=len(tf_train_dataset) * args.epochs,
+        weight_decay_rate=0.01,
+        num_warmup_steps=0,
+    )
+    distiller = Distiller(student, teacher, alpha=args.alpha, temperature=args.temperature)
+    distiller.compile(optimizer=optimizer)
+    distiller.fit(tf_train_dataset, validation_data=tf_val_dataset, epochs=args.epochs,
+                  callbacks=[tf.keras.callbacks.EarlyStopping(patience=2, restore_best_weights=True)])
+
+    # config.json + tf_model.h5 like finetuned_bert2, plus the tokenizer so the directory loads offline
+    student.save_pretrained(args.output)
+    tokenizer.save_pretrained(args.output)
+    print(f"student ({args.num_layers} layers, hidden {args.hidden_size}) saved to {args.output}")
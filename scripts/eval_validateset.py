@@ -1,53 +1,202 @@
-from transformers import TFAutoModelForTokenClassification, PretrainedConfig, BertConfig, AutoTokenizer, DataCollatorForTokenClassification
+from transformers import TFAutoModelForTokenClassification, PretrainedConfig, BertConfig, AutoTokenizer
 from tensorflow import keras
-from datasets import Dataset, load_metric
-import pandas as pd 
 import numpy as np
 import tensorflow as tf
-import ast, os, pickle
-
-# sub-word tokenization using pre-trained autotokenizer
-def tokenize_and_align_labels(batch): 
-
-    tag2int = {'B-POI':0, 'B-STR':1, 'E-POI':2, 'E-STR':3, 'I-POI':4,
-           'I-STR':5, 'S-POI':6, 'S-STR':7, 'O':8}
-           
-    tokenized_inputs = tokenizer(batch['tokens'], is_split_into_words=True)
-    labels=[]
-    for idx, label in enumerate(batch['tags']):
-        word_ids = tokenized_inputs.word_ids(batch_index = idx)
-        previous_word_idx = None
-        label_ids = []
-        for word_idx in word_ids: 
-            if word_idx is None:
-                label_ids.append(-100)
-            elif word_idx != previous_word_idx:
-                label_ids.append(tag2int[label[word_idx]])
-            else: 
-                label_ids.append(tag2int[label[word_idx]])
-            previous_word_idx = word_idx
-        labels.append(label_ids)
-    tokenized_inputs['labels'] = labels
-
-    return tokenized_inputs
-
-def encode_dataset(ds):
-    return ds.map(tokenize_and_align_labels, batched= True, remove_columns=['tags','tokens', 'index'])
-
-def evaluate(model, dataset, ner_labels):
-        all_predictions = []
-        all_labels = []
-        for batch in dataset:
-            logits = model.predict(batch)["logits"]
-            labels = batch["labels"]
-            predictions = np.argmax(logits, axis=-1)
-            for prediction, label in zip(predictions, labels):
-                for predicted_idx, label_idx in zip(prediction, label):
-                    if label_idx == -100:
-                        continue
-                    all_predictions.append(ner_labels[predicted_idx])
-                    all_labels.append(ner_labels[label_idx])
-        return metric.compute(predictions=[all_predictions], references=[all_labels])
+import os, pickle
+from pretokenize import load_or_build_cache, to_tf_dataset
+from reconstruct import O, POI, STR, POI_STR, vote_tables, argmax_labels, compress_tag, recon_compress_tag
+
+# label id per token for one collated batch; other backends (e.g. TFLite) pass their own predict_fn
+def predict_label_ids(model, batch): 
+    inputs = {name: value for name, value in batch.items() if name not in ('labels', 'word_ids')}
+    logits = model.predict(inputs, verbose=0)["logits"]
+    return argmax_labels(logits)
+
+
+# IOBES prefixes as small ints, so the entity boundaries of a whole batch are found with array operations
+BEGIN, INSIDE, END, SINGLE, OUTSIDE = range(5)
+PREFIXES = {'B': BEGIN, 'I': INSIDE, 'E': END, 'S': SINGLE, 'O': OUTSIDE}
+
+
+def prf(tp, n_pred, n_true):
+    # precision, recall, f1 as seqeval reports them: 0 where a denominator is 0
+    precision = tp / n_pred if n_pred > 0 else 0.0
+    recall = tp / n_true if n_true > 0 else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.0
+    return precision, recall, f1
+
+
+class EntityMetrics():
+    """
+    Entity-level precision / recall / f1 per type, computed like seqeval's default (non-strict) mode
+    from integer label ids, batch by batch. Every row is its own sentence: an entity never spans two addresses.
+
+    Only counts are kept between batches, so memory does not grow with the size of the validation set.
+    """
+
+    def __init__(self, ner_labels):
+        # label id -> prefix id and entity type id (-1 for O)
+        self.types = sorted({label.split('-', 1)[1] for label in ner_labels if label != 'O'})
+        self.prefix_table = np.array([PREFIXES[label.split('-', 1)[0]] for label in ner_labels], dtype=np.int8)
+        self.type_table = np.array([self.types.index(label.split('-', 1)[1]) if label != 'O' else -1 for label in ner_labels],
+                                   dtype=np.int8)
+        self.tp = np.zeros(len(self.types), dtype=np.int64)
+        self.n_pred = np.zeros(len(self.types), dtype=np.int64)
+        self.n_true = np.zeros(len(self.types), dtype=np.int64)
+        self.n_correct_tokens = 0
+        self.n_tokens = 0
+
+    def entities(self, label_ids, first, last):
+        """
+        (begin, end, type) of every entity in the flat label ids of several sentences, as one int64 key each.
+
+        Args:
+            - label_ids: 1-d label ids of the labelled tokens of consecutive sentences
+            - first, last: boolean masks of each sentence's first and last token
+        """
+        prefix = self.prefix_table[label_ids]
+        types = self.type_table[label_ids]
+        # previous token's tag; a sentence starts after an O, as seqeval's sentence separator
+        prev_prefix = np.where(first, OUTSIDE, np.roll(prefix, 1))
+        prev_type = np.where(first, -1, np.roll(types, 1))
+        type_change = prev_type != types
+
+        # seqeval's end_of_chunk (an entity ends on the previous token) and start_of_chunk (one starts here)
+        chunk_end = (np.isin(prev_prefix, [END, SINGLE])
+                     | (np.isin(prev_prefix, [BEGIN, INSIDE]) & np.isin(prefix, [BEGIN, SINGLE, OUTSIDE]))
+                     | ((prev_prefix != OUTSIDE) & type_change))
+        chunk_start = (np.isin(prefix, [BEGIN, SINGLE])
+                       | (np.isin(prev_prefix, [END, SINGLE, OUTSIDE]) & np.isin(prefix, [END, INSIDE]))
+                       | ((prefix != OUTSIDE) & type_change))
+
+        ends = np.sort(np.concatenate([np.flatnonzero(chunk_end & ~first) - 1, np.flatnonzero(last & (prefix != OUTSIDE))]))
+        # every entity begins at the last chunk start up to its end
+        positions = np.arange(len(label_ids))
+        begins = np.maximum.accumulate(np.where(chunk_start, positions, 0))[ends]
+        return (begins * len(label_ids) + ends) * len(self.types) + types[ends]
+
+    def update(self, labels, predictions):
+        """
+        Add one batch: (rows, seq_len) gold and predicted label ids; gold -100 marks tokens that are not scored.
+        """
+        labels = np.asarray(labels)
+        valid = labels != -100
+        position = np.cumsum(valid, axis=1)
+        first = (valid & (position == 1))[valid]
+        last = (valid & (position == position[:, -1:]))[valid]
+        true_ids = labels[valid]
+        pred_ids = np.asarray(predictions)[valid]
+
+        true_entities = self.entities(true_ids, first, last)
+        pred_entities = self.entities(pred_ids, first, last)
+        matched = np.intersect1d(true_entities, pred_entities, assume_unique=True)
+        n_types = len(self.types)
+        self.tp += np.bincount(matched % n_types, minlength=n_types)
+        self.n_pred += np.bincount(pred_entities % n_types, minlength=n_types)
+        self.n_true += np.bincount(true_entities % n_types, minlength=n_types)
+        self.n_correct_tokens += int((true_ids == pred_ids).sum())
+        self.n_tokens += len(true_ids)
+
+    def compute(self):
+        # same keys as the `seqeval` metric of datasets.load_metric
+        results = {}
+        for i, name in enumerate(self.types):
+            precision, recall, f1 = prf(self.tp[i], self.n_pred[i], self.n_true[i])
+            results[name] = {'precision': precision, 'recall': recall, 'f1': f1, 'number': int(self.n_true[i])}
+        precision, recall, f1 = prf(self.tp.sum(), self.n_pred.sum(), self.n_true.sum())
+        results.update({'overall_precision': precision, 'overall_recall': recall, 'overall_f1': f1,
+                        'overall_accuracy': self.n_correct_tokens / self.n_tokens if self.n_tokens > 0 else 0.0})
+        return results
+
+
+class WordMetrics():
+    """
+    Word-level scores of what the extraction returns: predicted sub-word labels go through compress_tag
+    and recon_compress_tag as in pred.py, and each word's POI / street tag is compared with its gold label's type.
+    POI_STR words count as POI, as split_elements puts them in the poi.
+
+    Also counts addresses whose whole POI / street / both were extracted exactly, the competition's criterion.
+    """
+
+    def __init__(self, ner_labels):
+        id2label = dict(enumerate(ner_labels))
+        self.poi_table, self.str_table = vote_tables(id2label)
+        self.word_tag_table = np.array([POI if label.endswith('-POI') else STR if label.endswith('-STR') else O
+                                        for label in ner_labels], dtype=np.int8)
+        self.counts = {name: np.zeros(3, dtype=np.int64) for name in ('POI', 'STR')}
+        self.n_correct_words = 0
+        self.n_words = 0
+        self.exact = {'poi': 0, 'street': 0, 'both': 0}
+        self.n_rows = 0
+
+    def update(self, labels, predictions, word_ids):
+        labels = np.asarray(labels)
+        word_ids = np.asarray(word_ids)
+        n_rows = word_ids.shape[0]
+
+        pred_tags = recon_compress_tag(compress_tag(np.asarray(predictions), word_ids, self.poi_table, self.str_table))
+        pred_tags[pred_tags == POI_STR] = POI
+        n_words = pred_tags.shape[1]
+
+        # every sub-word of a word carries the word's gold label
+        valid = word_ids >= 0
+        true_tags = np.full(n_rows * n_words, O, dtype=np.int8)
+        true_tags[(np.arange(n_rows)[:, None] * n_words + word_ids)[valid]] = self.word_tag_table[labels[valid]]
+        true_tags = true_tags.reshape(n_rows, n_words)
+
+        is_word = np.arange(n_words) < word_ids.max(axis=1, initial=-1)[:, None] + 1
+        for name, tag in (('POI', POI), ('STR', STR)):
+            self.counts[name] += [((pred_tags == tag) & (true_tags == tag)).sum(), (pred_tags == tag).sum(), (true_tags == tag).sum()]
+        self.n_correct_words += int(((pred_tags == true_tags) & is_word).sum())
+        self.n_words += int(is_word.sum())
+
+        poi_exact = ((pred_tags == POI) == (true_tags == POI)).all(axis=1)
+        street_exact = ((pred_tags == STR) == (true_tags == STR)).all(axis=1)
+        self.exact['poi'] += int(poi_exact.sum())
+        self.exact['street'] += int(street_exact.sum())
+        self.exact['both'] += int((poi_exact & street_exact).sum())
+        self.n_rows += n_rows
+
+    def compute(self):
+        results = {}
+        for name, (tp, n_pred, n_true) in self.counts.items():
+            precision, recall, f1 = prf(tp, n_pred, n_true)
+            results[name] = {'precision': precision, 'recall': recall, 'f1': f1, 'number': int(n_true)}
+        results['accuracy'] = self.n_correct_words / self.n_words if self.n_words > 0 else 0.0
+        for name, n_exact in self.exact.items():
+            results[name + '_exact_match'] = n_exact / self.n_rows if self.n_rows > 0 else 0.0
+        return results
+
+
+def evaluate(model, dataset, ner_labels, predict_fn=None):
+    """
+    Entity-level scores per type (seqeval's keys), plus word-level scores under 'words' when the batches carry word_ids.
+    """
+    predict_fn = predict_fn or (lambda batch: predict_label_ids(model, batch))
+    entity_metrics = EntityMetrics(ner_labels)
+    word_metrics = WordMetrics(ner_labels)
+    has_word_ids = False
+    for batch in dataset:
+        predictions = np.asarray(predict_fn(batch))
+        labels = np.asarray(batch["labels"])
+        entity_metrics.update(labels, predictions)
+        if "word_ids" in batch:
+            has_word_ids = True
+            word_metrics.update(labels, predictions, np.asarray(batch["word_ids"]))
+    results = entity_metrics.compute()
+    if has_word_ids:
+        results['words'] = word_metrics.compute()
+    return results
+
+def load_validation_dataset(csv_path="train_df_pretokenization.csv", model_ckpt="indobenchmark/indobert-base-p2", batch_size=512, 
+                            cache_dir="pretokenized"): 
+    # Check performance on validation set: the same split finetune_bert.py trained with, memory-mapped from pretokenize.py's cache
+    tokenizer = AutoTokenizer.from_pretrained(model_ckpt) 
+    meta, arrays = load_or_build_cache(csv_path, tokenizer, cache_dir)
+
+    # create tf datasets as model inputs; word ids are kept for the word-level scores
+    tf_val_dataset = to_tf_dataset(arrays, 'test', batch_size, tokenizer.pad_token_id, with_word_ids=True)
+    return tf_val_dataset
 
 if __name__ == "__main__":
     
@@ -56,34 +205,9 @@ if __name__ == "__main__":
     config = BertConfig.from_json_file(os.path.join(finetuned_bert2_dir,"config.json"))
     model =  TFAutoModelForTokenClassification.from_pretrained(os.path.join(finetuned_bert2_dir,"tf_model.h5"), config = config)
 
-    # Check performance on validation set: perform the split again 
-    df_converters = {'tokens': ast.literal_eval, 'labels': ast.literal_eval}
-    df = pd.read_csv("train_df_pretokenization.csv", converters=df_converters) 
-
-    model_ckpt = "indobenchmark/indobert-base-p2" # specify model id 
-    tokenizer = AutoTokenizer.from_pretrained(model_ckpt) 
-
-    # tokenization and align lables to sub-words
-    df = df.rename(columns={"labels": "tags"})    
-    ds = Dataset.from_pandas(df)
-    ds_encoded = encode_dataset(ds)
-
-    # split into training and validating 
-    test_size=0.15
-    processed_dataset = ds_encoded.shuffle(seed=42).train_test_split(test_size=test_size)
-
-    data_collator = DataCollatorForTokenClassification(tokenizer, return_tensors="tf", padding = 'longest')
-
-    # create tf datasets as model inputs 
-    tf_val_dataset = processed_dataset['test'].to_tf_dataset(
-        columns= ['input_ids', 'token_type_ids', 'attention_mask', 'labels'],
-        shuffle=False,
-        batch_size=512,
-        collate_fn=data_collator
-    )
+    tf_val_dataset = load_validation_dataset()
     
     # evaluate
-    metric = load_metric("seqeval")
     results = evaluate(model, tf_val_dataset, ner_labels=list(model.config.id2label.values()))
     
     with open(os.path.join(finetuned_bert2_dir,"eval_validation.pkl"), 'wb') as f:
@@ -0,0 +1,31 @@
+import os
+import argparse
+from transformers import TFAutoModelForTokenClassification, BertConfig, AutoTokenizer
+
+
+# write tokenizer files, config (incl. the id2label/label2id map) and weights into one directory
+def export_bundle(finetuned_bert2_dir, output_dir, model_ckpt="indobenchmark/indobert-base-p2"): 
+    os.makedirs(output_dir, exist_ok=True)
+
+    tokenizer = AutoTokenizer.from_pretrained(model_ckpt) 
+    tokenizer.save_pretrained(output_dir)
+
+    config = BertConfig.from_json_file(os.path.join(finetuned_bert2_dir,"config.json"))
+    model = TFAutoModelForTokenClassification.from_pretrained(os.path.join(finetuned_bert2_dir,"tf_model.h5"), config = config)
+    model.save_pretrained(output_dir)
+
+    # make sure the bundle loads on its own, without the hub
+    AutoTokenizer.from_pretrained(output_dir, local_files_only=True)
+    return output_dir
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Export the fine-tuned model and its tokenizer as one self-contained directory')
+    parser.add_argument('--model_dir', required=True, help='directory holding the fine-tuned config.json and tf_model.h5')
+    parser.add_argument('--output', required=True, help='bundle directory to write; pass it as model_dir to pred.py / pred_test.py')
+    parser.add_argument('--model_ckpt', default="indobenchmark/indobert-base-p2", help='hub id of the tokenizer the model was trained with')
+    args = parser.parse_args()
+
+    export_bundle(args.model_dir, args.output, args.model_ckpt)
+    print(f"bundle written to {args.output}: {sorted(os.listdir(args.output))}")
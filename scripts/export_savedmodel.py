@@ -0,0 +1,37 @@
+import os
+import argparse
+import tensorflow as tf
+from transformers import TFAutoModelForTokenClassification, BertConfig
+from pred_cache import write_source_record
+
+
+# SavedModel whose serving signature goes straight from padded ids to label ids (argmax done in the graph).
+# With weights_path (the tf_model.h5 `model` was loaded from), saved_model/source.json records it for pred.py
+def export_savedmodel(model, output_dir, weights_path=None): 
+
+    @tf.function(input_signature=[tf.TensorSpec([None, None], tf.int32, name="input_ids"), 
+                                  tf.TensorSpec([None, None], tf.int32, name="attention_mask")])
+    def serving_fn(input_ids, attention_mask): 
+        logits = model(input_ids=input_ids, attention_mask=attention_mask, training=False).logits
+        # label ids fit in int8 for this tag set; saves copying float logits back to the host
+        return {"label_ids": tf.cast(tf.argmax(logits, axis=-1, output_type=tf.int32), tf.int8)}
+
+    tf.saved_model.save(model, output_dir, signatures={"serving_default": serving_fn})
+    if weights_path is not None: 
+        write_source_record(output_dir, weights_path)
+    return output_dir
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Export the fine-tuned model as a SavedModel that returns label ids')
+    parser.add_argument('--model_dir', required=True, help='directory holding the fine-tuned config.json and tf_model.h5')
+    parser.add_argument('--output', default=None, help='SavedModel directory. Default: <model_dir>/saved_model, which pred.py picks up')
+    args = parser.parse_args()
+
+    weights_path = os.path.join(args.model_dir,"tf_model.h5")
+    config = BertConfig.from_json_file(os.path.join(args.model_dir,"config.json"))
+    model = TFAutoModelForTokenClassification.from_pretrained(weights_path, config = config)
+    output_dir = args.output or os.path.join(args.model_dir, "saved_model")
+    export_savedmodel(model, output_dir, weights_path)
+    print(f"SavedModel written to {output_dir}")
@@ -1,10 +1,9 @@
-from datasets import load_dataset, Dataset
-from transformers import AutoTokenizer, DataCollatorForTokenClassification, TFAutoModelForTokenClassification, create_optimizer
+from transformers import AutoTokenizer, BertConfig, TFAutoModelForTokenClassification, create_optimizer
 from tensorflow.keras.callbacks import TensorBoard as TensorboardCallback
 from tensorflow.keras.callbacks import EarlyStopping
 import tensorflow as tf
-import pandas as pd 
-import ast, os
+import argparse, os, time
+from pretokenize import load_or_build_cache, to_tf_dataset
 
 
 # set parameter: 
@@ -15,17 +14,19 @@ eval_batch_size = 128
 learning_rate = 2e-5
 weight_decay_rate=0.01
 output_dir = "/home/peetal/hulacon/street-element-extraction"
-#tf.keras.mixed_precision.set_global_policy("mixed_float16")
 
 
-# sub-word tokenization using pre-trained autotokenizer
-def tokenize_and_align_labels(batch): 
+# IOBES tags of POI and street
+tag2index = {'B-POI':0, 'B-STR':1, 'E-POI':2, 'E-STR':3, 'I-POI':4, 'I-STR':5, 'S-POI':6, 'S-STR':7, 'O':8}
+index2tag = {y: x for x, y in tag2index.items()}
+
 
-    tag2int = {'B-POI':0, 'B-STR':1, 'E-POI':2, 'E-STR':3, 'I-POI':4,
-           'I-STR':5, 'S-POI':6, 'S-STR':7, 'O':8}
+# sub-word tokenization using pre-trained autotokenizer
+def tokenize_and_align_labels(batch, tokenizer): 
            
     tokenized_inputs = tokenizer(batch['tokens'], is_split_into_words=True)
     labels=[]
+    all_word_ids=[]
     for idx, label in enumerate(batch['tags']):
         word_ids = tokenized_inputs.word_ids(batch_index = idx)
         previous_word_idx = None
@@ -34,83 +35,193 @@ def tokenize_and_align_labels(batch):
             if word_idx is None:
                 label_ids.append(-100)
             elif word_idx != previous_word_idx:
-                label_ids.append(tag2int[label[word_idx]])
+                label_ids.append(tag2index[label[word_idx]])
             else: 
-                label_ids.append(tag2int[label[word_idx]])
+                label_ids.append(tag2index[label[word_idx]])
             previous_word_idx = word_idx
         labels.append(label_ids)
+        all_word_ids.append([-1 if word_idx is None else word_idx for word_idx in word_ids])
     tokenized_inputs['labels'] = labels
+    # kept for word-level evaluation; not a model input
+    tokenized_inputs['word_ids'] = all_word_ids
 
     return tokenized_inputs
 
-def encode_dataset(ds):
-    return ds.map(tokenize_and_align_labels, batched= True, remove_columns=['tags','tokens', 'index'])
+def encode_dataset(ds, tokenizer):
+    return ds.map(tokenize_and_align_labels, batched= True, fn_kwargs={'tokenizer': tokenizer}, remove_columns=['tags','tokens', 'index'])
+
+
+# mean cross-entropy over real tokens; special tokens and padding (-100) are ignored
+def masked_token_loss(logits, labels):
+    mask = tf.cast(tf.not_equal(labels, -100), tf.float32)
+    loss = tf.keras.losses.sparse_categorical_crossentropy(tf.maximum(labels, 0), tf.cast(logits, tf.float32), from_logits=True)
+    return tf.reduce_sum(loss * mask) / tf.maximum(tf.reduce_sum(mask), 1.0)
+
+
+class GradientAccumulation(tf.keras.Model):
+    """
+    Train `model` with gradients summed over `accum_steps` batches before each optimizer step,
+    i.e. an effective batch of accum_steps * batch_size rows at the memory cost of one batch.
+    """
+
+    def __init__(self, model, accum_steps):
+        super().__init__()
+        self.token_model = model
+        self.accum_steps = accum_steps
+        # the model must be built to know its variables
+        self.token_model(self.token_model.dummy_inputs, training=False)
+        self._gradients = [tf.Variable(tf.zeros_like(v), trainable=False) for v in self.token_model.trainable_variables]
+        self._step = tf.Variable(0, dtype=tf.int64, trainable=False)
+
+    def call(self, inputs, training=False):
+        return self.token_model(inputs, training=training)
+
+    def _loss(self, data, training):
+        inputs = {k: v for k, v in data.items() if k != 'labels'}
+        return masked_token_loss(self.token_model(inputs, training=training).logits, data['labels'])
+
+    def _apply(self):
+        self.optimizer.apply_gradients(zip([g.read_value() for g in self._gradients], self.token_model.trainable_variables))
+        for g in self._gradients:
+            g.assign(tf.zeros_like(g))
+
+    def train_step(self, data):
+        # with mixed_float16, compile() wraps the optimizer in a LossScaleOptimizer
+        scaled = isinstance(self.optimizer, tf.keras.mixed_precision.LossScaleOptimizer)
+        with tf.GradientTape() as tape:
+            loss = self._loss(data, training=True)
+            scaled_loss = self.optimizer.get_scaled_loss(loss) if scaled else loss
+        gradients = tape.gradient(scaled_loss, self.token_model.trainable_variables)
+        if scaled:
+            gradients = self.optimizer.get_unscaled_gradients(gradients)
+        for accumulated, gradient in zip(self._gradients, gradients):
+            # embedding gradients come as IndexedSlices; variables the loss doesn't reach have none
+            if gradient is not None:
+                accumulated.assign_add(tf.convert_to_tensor(gradient) / self.accum_steps)
+        self._step.assign_add(1)
+        tf.cond(tf.equal(self._step % self.accum_steps, 0), self._apply, lambda: None)
+        return {"loss": loss}
+
+    def test_step(self, data):
+        return {"loss": self._loss(data, training=False)}
+
+
+class Throughput(tf.keras.callbacks.Callback):
+    # training samples/sec of every epoch, validation excluded; also added to the epoch logs (e.g. for TensorBoard)
+
+    def __init__(self, n_samples):
+        super().__init__()
+        self.n_samples = n_samples
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._start_time = time.perf_counter()
+        self._train_seconds = None
+
+    def on_test_begin(self, logs=None):
+        if self._train_seconds is None:
+            self._train_seconds = time.perf_counter() - self._start_time
+
+    def on_epoch_end(self, epoch, logs=None):
+        seconds = self._train_seconds or time.perf_counter() - self._start_time
+        samples_per_sec = self.n_samples / seconds
+        if logs is not None:
+            logs['samples_per_sec'] = samples_per_sec
+        print(f"epoch {epoch + 1}: {self.n_samples} samples in {seconds:.1f}s, {samples_per_sec:.1f} samples/sec")
+
+
+def pick_device(device="auto"):
+    # a GPU if asked for and present, the CPU otherwise
+    gpus = tf.config.list_physical_devices('GPU')
+    if device == "auto":
+        device = "gpu" if gpus else "cpu"
+    if device == "gpu" and not gpus:
+        print("no GPU found, training on CPU")
+        device = "cpu"
+    return '/device:GPU:0' if device == "gpu" else '/device:CPU:0'
+
+
+def tiny_config(vocab_size):
+    # a small random BERT for end-to-end runs on CPU
+    return BertConfig(vocab_size=vocab_size, hidden_size=32, num_hidden_layers=2, num_attention_heads=2, intermediate_size=64,
+                      id2label=index2tag, label2id=tag2index)
 
 
 if __name__ == "__main__": 
-    
-    # load dataset, 
-    df_converters = {'tokens': ast.literal_eval, 'labels': ast.literal_eval}
-    df = pd.read_csv("train_df_pretokenization.csv", converters=df_converters) 
-
-    model_ckpt = "indobenchmark/indobert-base-p2" # specify model id 
-    tokenizer = AutoTokenizer.from_pretrained(model_ckpt) 
 
-    # tokenization and align lables to sub-words
-    df = df.rename(columns={"labels": "tags"})    
-    ds = Dataset.from_pandas(df)
-    ds_encoded = encode_dataset(ds)
-
-    # split into training and validating 
-    test_size=.15
-    processed_dataset = ds_encoded.shuffle(seed=42).train_test_split(test_size=test_size)
-
-    data_collator = DataCollatorForTokenClassification(tokenizer, return_tensors="tf", padding = 'longest')
+    parser = argparse.ArgumentParser(description='Fine-tune BERT for IOBES token classification of POI and street')
+    parser.add_argument('--data_csv', default="train_df_pretokenization.csv", help='labelled csv written by labelling.py')
+    parser.add_argument('--model_ckpt', default="indobenchmark/indobert-base-p2", help='hub id or local directory of the pre-trained model')
+    parser.add_argument('--tokenizer', default=None, help='hub id or local directory of the tokenizer. Default: --model_ckpt')
+    parser.add_argument('--cache_dir', default="pretokenized", help='pre-tokenized dataset written by pretokenize.py (built if missing or stale)')
+    parser.add_argument('--output_dir', default=output_dir, help='TensorBoard logs go to <output_dir>/logs, the model to <output_dir>/finetuned_bert2')
+    parser.add_argument('--epochs', type=int, default=num_train_epochs)
+    parser.add_argument('--train_batch_size', type=int, default=train_batch_size, help='rows per batch (max rows per batch when bucketing)')
+    parser.add_argument('--eval_batch_size', type=int, default=eval_batch_size)
+    parser.add_argument('--learning_rate', type=float, default=learning_rate)
+    parser.add_argument('--weight_decay_rate', type=float, default=weight_decay_rate)
+    parser.add_argument('--num_warmup_steps', type=int, default=num_warmup_steps)
+    parser.add_argument('--mixed_precision', default="none", choices=["none", "float16", "bfloat16"], 
+                        help='float16 for GPUs, bfloat16 for CPUs/TPUs that support it')
+    parser.add_argument('--jit_compile', action='store_true', help='compile the train step with XLA')
+    parser.add_argument('--bucket_by_length', action='store_true', help='batch rows of similar length under --max_tokens, in shuffled order')
+    parser.add_argument('--max_tokens', type=int, default=8192, help='padded tokens per batch when bucketing')
+    parser.add_argument('--grad_accum_steps', type=int, default=1, help='batches per optimizer step')
+    parser.add_argument('--device', default="auto", choices=["auto", "gpu", "cpu"])
+    parser.add_argument('--tiny', action='store_true', help='train a small randomly initialised BERT instead of --model_ckpt')
+    parser.add_argument('--max_rows', type=int, default=None, help='only use the first rows of each split, e.g. for a quick CPU run')
+    args = parser.parse_args()
+
+    # the policy has to be set before the model is built
+    if args.mixed_precision != "none": 
+        tf.keras.mixed_precision.set_global_policy("mixed_" + args.mixed_precision)
+    device = pick_device(args.device)
+    print(f"training on {device}, precision: {tf.keras.mixed_precision.global_policy().name}")
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer or args.model_ckpt) 
+
+    # tokenized dataset and train/validation split, memory-mapped from the cache written by pretokenize.py
+    # (built here on first use, rebuilt when the csv or the tokenizer changes)
+    meta, arrays = load_or_build_cache(args.data_csv, tokenizer, args.cache_dir)
+    if args.max_rows is not None: 
+        arrays = dict(arrays, train_rows=arrays['train_rows'][:args.max_rows], test_rows=arrays['test_rows'][:args.max_rows])
 
     # create tf datasets as model inputs 
-    tf_train_dataset = processed_dataset['train'].to_tf_dataset(
-        columns= ['input_ids', 'token_type_ids', 'attention_mask', 'labels'],
-        shuffle=False,
-        batch_size=train_batch_size,
-        collate_fn=data_collator
-    )
-    tf_val_dataset = processed_dataset['test'].to_tf_dataset(
-        columns= ['input_ids', 'token_type_ids', 'attention_mask', 'labels'],
-        shuffle=False,
-        batch_size=eval_batch_size,
-        collate_fn=data_collator
-    )
-
-    # optimizer 
-    num_train_steps = len(tf_train_dataset) * num_train_epochs
+    max_tokens = args.max_tokens if args.bucket_by_length else None
+    # XLA compiles once per input shape, so with jit_compile the sequence length is padded to a few fixed buckets
+    tf_train_dataset = to_tf_dataset(arrays, 'train', args.train_batch_size, tokenizer.pad_token_id, max_tokens=max_tokens, 
+                                     shuffle_seed=42 if args.bucket_by_length else None, pad_to_buckets=args.jit_compile)
+    tf_val_dataset = to_tf_dataset(arrays, 'test', args.eval_batch_size, tokenizer.pad_token_id, max_tokens=max_tokens, 
+                                   pad_to_buckets=args.jit_compile)
+
+    # optimizer: one step per grad_accum_steps batches
+    num_train_steps = -(-len(tf_train_dataset) // args.grad_accum_steps) * args.epochs
     #num_warmup_steps=int(0.1 * num_train_steps)
     optimizer, lr_schedule = create_optimizer(
-        init_lr=learning_rate,
+        init_lr=args.learning_rate,
         num_train_steps=num_train_steps,
-        weight_decay_rate=weight_decay_rate,
-        num_warmup_steps=num_warmup_steps,
-    )
-
-    # config model 
-    tag2index = {'B-POI':0, 'B-STR':1, 'E-POI':2, 'E-STR':3, 'I-POI':4, 'I-STR':5, 'S-POI':6, 'S-STR':7, 'O':8}
-    index2tag = {y: x for x, y in tag2index.items()}
-    model = TFAutoModelForTokenClassification.from_pretrained(
-        model_ckpt,
-        id2label=index2tag,
-        label2id=tag2index
+        weight_decay_rate=args.weight_decay_rate,
+        num_warmup_steps=args.num_warmup_steps,
     )
 
-    model.compile(optimizer=optimizer)
-
-    # set call back
-    callbacks=[]
-    callbacks.append(TensorboardCallback(log_dir=os.path.join(output_dir,"logs")))
-    callbacks.append(EarlyStopping(patience=2, restore_best_weights=True))
-    
-    
-    with tf.device('/device:GPU:0'):
-        print("Num GPUs Available: ", len(tf.config.list_physical_devices('GPU')))
-        model.fit(tf_train_dataset, validation_data=tf_val_dataset,callbacks=callbacks, epochs=num_train_epochs)
-
-    model.save_pretrained("/home/peetal/hulacon/street-element-extraction/finetuned_bert2")
-
+    with tf.device(device): 
+        # config model 
+        if args.tiny: 
+            model = TFAutoModelForTokenClassification.from_config(tiny_config(len(tokenizer)))
+        else: 
+            model = TFAutoModelForTokenClassification.from_pretrained(
+                args.model_ckpt,
+                id2label=index2tag,
+                label2id=tag2index
+            )
+        trainer = model if args.grad_accum_steps == 1 else GradientAccumulation(model, args.grad_accum_steps)
+        trainer.compile(optimizer=optimizer, jit_compile=args.jit_compile)
+
+        # set call back
+        callbacks=[]
+        callbacks.append(Throughput(len(arrays['train_rows'])))
+        callbacks.append(TensorboardCallback(log_dir=os.path.join(args.output_dir,"logs")))
+        callbacks.append(EarlyStopping(patience=2, restore_best_weights=True))
+
+        trainer.fit(tf_train_dataset, validation_data=tf_val_dataset, callbacks=callbacks, epochs=args.epochs)
+
+    model.save_pretrained(os.path.join(args.output_dir, "finetuned_bert2"))
@@ -0,0 +1,189 @@
+import os, json, time, heapq, random, logging, threading, cProfile
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from urllib import request
+
+logger = logging.getLogger(__name__)
+
+# Stage timings and counters of AddressElementExtract. The extractor always calls stage()/count();
+# without metrics it gets NULL_METRICS, whose stage() hands back one shared no-op context manager.
+_NO_OP = nullcontext()
+
+
+class NullMetrics():
+
+    def stage(self, name):
+        return _NO_OP
+
+    def count(self, **increments):
+        pass
+
+
+NULL_METRICS = NullMetrics()
+
+
+class PipelineMetrics():
+    """
+    Wall time and call count per pipeline stage, plus counters (rows, tokens, padding tokens, ...).
+
+    `hooks` are called as hook(stage, seconds) after every timed stage, e.g. to feed another metrics system.
+    Safe to update from one thread and read from others (serve.py's batching and request threads).
+    """
+
+    def __init__(self, hooks=()):
+        self.hooks = list(hooks)
+        self._lock = threading.Lock()
+        self.stage_seconds = Counter()
+        self.stage_calls = Counter()
+        self.counters = Counter()
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    @contextmanager
+    def stage(self, name):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start_time
+            with self._lock:
+                self.stage_seconds[name] += seconds
+                self.stage_calls[name] += 1
+            for hook in self.hooks:
+                hook(name, seconds)
+
+    def count(self, **increments):
+        with self._lock:
+            self.counters.update(increments)
+
+    def snapshot(self):
+        with self._lock:
+            return {"stages": {name: {"seconds": self.stage_seconds[name], "calls": self.stage_calls[name]}
+                               for name in self.stage_seconds},
+                    "counters": dict(self.counters)}
+
+    def to_prometheus(self, prefix="address_extract"):
+        snapshot = self.snapshot()
+        lines = [f"# TYPE {prefix}_stage_seconds_total counter"]
+        lines += [f'{prefix}_stage_seconds_total{{stage="{name}"}} {stage["seconds"]:.6f}' for name, stage in snapshot["stages"].items()]
+        lines.append(f"# TYPE {prefix}_stage_calls_total counter")
+        lines += [f'{prefix}_stage_calls_total{{stage="{name}"}} {stage["calls"]}' for name, stage in snapshot["stages"].items()]
+        for name, value in snapshot["counters"].items():
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            lines.append(f"{prefix}_{name}_total {value}")
+        return "\n".join(lines) + "\n"
+
+    def to_json_line(self):
+        return json.dumps(dict(self.snapshot(), time=time.time())) + "\n"
+
+
+class MetricsExporter():
+    """
+    Write `metrics` to a local file or POST them to an endpoint, once per export() call or every `interval` seconds.
+
+    format "prometheus": the file is replaced with the current text exposition (node_exporter textfile style);
+    format "jsonl": one JSON snapshot is appended per export.
+
+    A failed periodic export (endpoint down, disk full) is logged and retried at the next interval; so is
+    the final one in close(). Only a direct export() call raises.
+    """
+
+    def __init__(self, metrics, path=None, url=None, format="prometheus", interval=None):
+        if format not in ("prometheus", "jsonl"):
+            raise ValueError(f"unknown metrics format {format!r}, expected 'prometheus' or 'jsonl'")
+        self.metrics = metrics
+        self.path = path
+        self.url = url
+        self.format = format
+        self._stop = threading.Event()
+        self._thread = None
+        if interval is not None:
+            self._thread = threading.Thread(target=self._run, args=(interval,), daemon=True)
+            self._thread.start()
+
+    def export(self):
+        if self.format == "prometheus":
+            payload, content_type = self.metrics.to_prometheus(), "text/plain; version=0.0.4"
+        else:
+            payload, content_type = self.metrics.to_json_line(), "application/json"
+
+        if self.path is not None:
+            if self.format == "prometheus":
+                # write then rename, so a scraper never reads a half-written file
+                tmp_path = self.path + ".tmp"
+                with open(tmp_path, 'w') as f:
+                    f.write(payload)
+                os.replace(tmp_path, self.path)
+            else:
+                with open(self.path, 'a') as f:
+                    f.write(payload)
+        if self.url is not None:
+            req = request.Request(self.url, data=payload.encode("utf-8"), headers={"Content-Type": content_type}, method="POST")
+            with request.urlopen(req, timeout=10):
+                pass
+
+    def _try_export(self):
+        try:
+            self.export()
+        except Exception as e:
+            logger.error("metrics export failed: %r", e)
+
+    def _run(self, interval):
+        while not self._stop.wait(interval):
+            self._try_export()
+
+    def close(self):
+        # stop the background thread and write the final numbers
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._try_export()
+
+
+class SlowRequestProfiler():
+    """
+    Profile a random `sample_rate` share of requests with cProfile and keep the `n_slowest` of them;
+    dump() writes their stats as <output_dir>/slow_<rank>_<ms>ms.prof, readable with pstats or snakeviz.
+    """
+
+    def __init__(self, output_dir, n_slowest=10, sample_rate=1.0):
+        self.output_dir = output_dir
+        self.n_slowest = n_slowest
+        self.sample_rate = sample_rate
+        self._lock = threading.Lock()
+        # min-heap of (seconds, sequence number, profile): the fastest kept request is replaced first
+        self._slowest = []
+        self._seq = 0
+
+    @contextmanager
+    def request(self, n_rows):
+        if random.random() >= self.sample_rate:
+            yield
+            return
+        profile = cProfile.Profile()
+        start_time = time.perf_counter()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            seconds = time.perf_counter() - start_time
+            with self._lock:
+                self._seq += 1
+                entry = (seconds, self._seq, n_rows, profile)
+                if len(self._slowest) < self.n_slowest:
+                    heapq.heappush(self._slowest, entry)
+                elif seconds > self._slowest[0][0]:
+                    heapq.heapreplace(self._slowest, entry)
+
+    def dump(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        with self._lock:
+            slowest = sorted(self._slowest, reverse=True)
+        paths = []
+        for rank, (seconds, _, n_rows, profile) in enumerate(slowest):
+            path = os.path.join(self.output_dir, f"slow_{rank}_{seconds * 1e3:.0f}ms_{n_rows}rows.prof")
+            profile.dump_stats(path)
+            paths.append(path)
+        return paths
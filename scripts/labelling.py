@@ -0,0 +1,153 @@
+import multiprocessing, json
+import argparse
+import pandas as pd
+from string import punctuation
+from cleaning import clean
+
+# Word-level IOBES labelling of the training csv (id, raw_address, POI/street) -> train_df_pretokenization.csv,
+# the labelling cells of preprocessing.ipynb as a module. Rows are plain tuples of lists, no DataFrame row access.
+
+
+def stripclean(arr):
+    return [s.strip().strip(punctuation) for s in arr]
+
+
+def _label_span(target, tag, strip_tokens, full_tokens, labels, i, abbreviations):
+    """
+    Label `target` (the POI or street words) as a span starting at word i, if every word of the address there
+    is a prefix of the target word. Returns (found, overlap, shorten).
+    """
+    n = len(target)
+    if i + n > len(strip_tokens):
+        return False, False, False
+    for j in range(n):
+        if not target[j].startswith(strip_tokens[i + j]):
+            return False, False, False
+
+    overlap, shorten = False, False
+    for j in range(n):
+        if labels[i + j] != 'O':
+            overlap = True
+        if n == 1:       labels[i + j] = 'S-' + tag
+        elif j == 0:     labels[i + j] = 'B-' + tag
+        elif j == n - 1: labels[i + j] = 'E-' + tag
+        else:            labels[i + j] = 'I-' + tag
+        # an abbreviated word of the address: label it and remember the full word it stands for
+        if strip_tokens[i + j] != target[j]:
+            full_tokens[i + j] = full_tokens[i + j].replace(strip_tokens[i + j], target[j])
+            labels[i + j] += '-SHORT'
+            shorten = True
+            abbreviations.append((strip_tokens[i + j], target[j]))
+    return True, overlap, shorten
+
+
+def label_row(raw_address, poi_street):
+    """
+    IOBES labels of one address.
+
+    Returns (tokens, labels, full_tokens, found_poi, found_str, shorten, overlap, abbreviations):
+    labels carry a -SHORT suffix on abbreviated words, full_tokens has those words expanded,
+    abbreviations lists (abbreviated word, full word) in the order they were found.
+    """
+    elements = poi_street.split('/')
+    poi = stripclean(clean(elements[0]).split())
+    street = stripclean(clean(elements[1]).split())
+    tokens = clean(raw_address.strip()).split()
+    strip_tokens = stripclean(tokens)
+    full_tokens = list(tokens)
+    labels = ['O'] * len(tokens)
+    abbreviations = []
+
+    found_poi, found_str, shorten, overlap = False, False, False, False
+    for i in range(len(strip_tokens)):
+        if strip_tokens[i] == '': continue
+        # POI before street at every word, so overlapping spans resolve as in the notebook
+        for target, tag in ((poi, 'POI'), (street, 'STR')):
+            if len(target) > 0 and target[0].startswith(strip_tokens[i]):
+                found, span_overlap, span_shorten = _label_span(target, tag, strip_tokens, full_tokens, labels, i, abbreviations)
+                if found:
+                    if tag == 'POI': found_poi = True
+                    else:            found_str = True
+                    overlap |= span_overlap
+                    shorten |= span_shorten
+
+    return (tokens, labels, full_tokens, len(poi) > 0 and not found_poi, len(street) > 0 and not found_str,
+            shorten, overlap, abbreviations)
+
+
+def label_rows(rows):
+    # pool task: a list of (raw_address, POI/street) pairs
+    return [label_row(raw_address, poi_street) for raw_address, poi_street in rows]
+
+
+def label_dataframe(train_df, workers=1, chunk_size=10000):
+    """
+    Label every row of the training dataframe (columns id, raw_address, POI/street).
+
+    Returns (out_df, errors, wordlist_raw):
+        - out_df: columns index, tokens, labels as written to train_df_pretokenization.csv. Rows with a POI or street
+          that could not be found, or with overlapping spans, are dropped; rows with abbreviations are moved to the
+          end with the abbreviations expanded and -SHORT removed from their labels.
+        - errors: {'POI': [ids], 'STR': [ids], 'OVERLAP': set of ids, 'SHORTEN': [ids]}
+        - wordlist_raw: {abbreviated word: {full word: count}} over all rows, including dropped ones
+    """
+    ids = train_df['id'].tolist()
+    rows = list(zip(train_df['raw_address'].tolist(), train_df['POI/street'].tolist()))
+    chunks = [rows[start:start + chunk_size] for start in range(0, len(rows), chunk_size)]
+
+    if workers > 1:
+        with multiprocessing.get_context('spawn').Pool(workers) as pool:
+            # imap hands chunks back in submission order, so results stay in row order
+            results = [r for chunk_results in pool.imap(label_rows, chunks) for r in chunk_results]
+    else:
+        results = [r for chunk in chunks for r in label_rows(chunk)]
+
+    wordlist_raw = {}
+    errors = {'POI': [], 'STR': [], 'OVERLAP': set(), 'SHORTEN': []}
+    for row_id, (tokens, labels, full_tokens, poi_err, str_err, shorten, overlap, abbreviations) in zip(ids, results):
+        for short, full in abbreviations:
+            counts = wordlist_raw.setdefault(short, {})
+            counts[full] = counts.get(full, 0) + 1
+        if overlap:
+            errors['OVERLAP'].add(row_id)
+        if poi_err:
+            errors['POI'].append(row_id)
+        if str_err:
+            errors['STR'].append(row_id)
+        if shorten:
+            errors['SHORTEN'].append(row_id)
+
+    # drop error rows by id; abbreviated rows go last with expanded tokens, as the notebook appends them
+    err_ids = set(errors['POI']) | set(errors['STR']) | errors['OVERLAP']
+    shorten_ids = set(errors['SHORTEN'])
+    kept, shortened = [], []
+    for index, row_id, (tokens, labels, full_tokens, *_) in zip(train_df.index, ids, results):
+        if row_id in err_ids:
+            continue
+        if row_id in shorten_ids:
+            shortened.append((index, full_tokens, [s.replace('-SHORT', '') for s in labels]))
+        else:
+            kept.append((index, tokens, labels))
+    out_df = pd.DataFrame(kept + shortened, columns=['index', 'tokens', 'labels'])
+    return out_df, errors, wordlist_raw
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Label the training csv with word-level IOBES tags for POI and street')
+    parser.add_argument('--input', default="train.csv", help='training csv with columns id, raw_address, POI/street')
+    parser.add_argument('--output', default="train_df_pretokenization.csv", help='labelled csv with columns index, tokens, labels')
+    parser.add_argument('--wordlist', default=None, help='optional json file for the abbreviation counts {short: {full: count}}')
+    parser.add_argument('--workers', type=int, default=1, help='labelling processes')
+    parser.add_argument('--chunk_size', type=int, default=10000, help='rows per pool task')
+    args = parser.parse_args()
+
+    train_df = pd.read_csv(args.input)
+    out_df, errors, wordlist_raw = label_dataframe(train_df, workers=args.workers, chunk_size=args.chunk_size)
+    out_df.to_csv(args.output, index = False)
+    print(f"POI not found: {len(errors['POI'])}, street not found: {len(errors['STR'])}, overlapping: {len(errors['OVERLAP'])}, "
+          f"abbreviated: {len(errors['SHORTEN'])}; wrote {len(out_df)} rows to {args.output}")
+
+    if args.wordlist is not None:
+        with open(args.wordlist, 'w') as f:
+            json.dump(wordlist_raw, f, ensure_ascii=False)
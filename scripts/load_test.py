@@ -0,0 +1,38 @@
+import json, time
+import argparse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+
+
+def post_address(url, address):
+    request = urllib.request.Request(url + "/extract", data=json.dumps({"address": address}).encode("utf-8"),
+                                     headers={"Content-Type": "application/json"})
+    start_time = time.perf_counter()
+    with urllib.request.urlopen(request) as response:
+        json.loads(response.read())
+    return time.perf_counter() - start_time
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Load-test a running serve.py with addresses from a csv')
+    parser.add_argument('--url', default="http://127.0.0.1:8000")
+    parser.add_argument('--input', default="../data/test.csv", help='csv with a raw_address column')
+    parser.add_argument('--requests', type=int, default=2000, help='number of requests to send')
+    parser.add_argument('--concurrency', type=int, default=32, help='requests in flight at once')
+    args = parser.parse_args()
+
+    addresses = pd.read_csv(args.input, dtype={'raw_address': str}, keep_default_na=False)['raw_address'].tolist()
+    addresses = (addresses * (args.requests // len(addresses) + 1))[:args.requests]
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        latencies_ms = np.array(list(pool.map(lambda address: post_address(args.url, address), addresses))) * 1e3
+    elapsed = time.perf_counter() - start_time
+
+    print(f"{len(addresses)} requests, concurrency {args.concurrency}: {len(addresses) / elapsed:.1f} req/sec")
+    print(f"client latency p50 {np.percentile(latencies_ms, 50):.1f} ms, p99 {np.percentile(latencies_ms, 99):.1f} ms")
+    with urllib.request.urlopen(args.url + "/metrics") as response:
+        print("server metrics:", json.dumps(json.loads(response.read()), indent=2))
@@ -1,13 +1,20 @@
-from string import punctuation
-import re, os
-import tqdm
-from transformers import TFAutoModelForTokenClassification, PretrainedConfig, BertConfig, AutoTokenizer, DataCollatorForTokenClassification
-from collections import defaultdict
+import re, os, warnings
 import numpy as np 
-import pandas as pd
-from datasets import Dataset
+from cleaning import clean, clean_many, make_cached_clean
+from pred_cache import PredictionCache, model_key, exported_from
+from batching import fixed_batches, length_bucketed_batches, padding_efficiency, bucket_length, pad_rows, window_rows
+from abbreviations import AbbreviationIndex
+from instrumentation import NULL_METRICS
+from reconstruct import (vote_tables, argmax_labels, batch_word_ids, word_id_matrix, vote_segments, votes_to_tags, 
+                         ragged_to_matrix, recon_compress_tag, split_elements)
 import logging
 import argparse
+
+# TensorFlow and transformers take seconds to import, so they are only imported when a model is loaded.
+# A model directory written by export_bundle.py holds the tokenizer too and loads without network access.
+DEFAULT_MODEL_DIR = os.environ.get("ADDRESS_MODEL_DIR", "/Users/peetal/Desktop/street-element-extraction/finetuned_bert2")
+MODEL_CKPT = "indobenchmark/indobert-base-p2" # tokenizer used when the model directory has none
+
 def set_global_logging_level(level=logging.ERROR, prefices=[""]):
     """
     Override logging levels of different modules based on their name as a prefix.
@@ -23,170 +30,239 @@ def set_global_logging_level(level=logging.ERROR, prefices=[""]):
     for name in logging.root.manager.loggerDict:
         if re.match(prefix_re, name):
             logging.getLogger(name).setLevel(level)
-set_global_logging_level(logging.ERROR)
 
 
-parser = argparse.ArgumentParser(description='Post-fmriprep pipeline for DIVATTEN')
-parser.add_argument(
-    '--address',
-    required=True,
-    action='store',
-    help='raw address')
-args = parser.parse_args()
+def set_tf_threads(intra_op_threads=0, inter_op_threads=0): 
+    """
+    Limit TensorFlow's thread pools, e.g. so several worker processes don't oversubscribe the cores.
+    Must be called before the model is loaded. 0 keeps TensorFlow's default (all cores).
+    """
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+
 
 class AddressElementExtract(): 
 
-    def __init__(self): 
+    def __init__(self, finetuned_bert2_dir=DEFAULT_MODEL_DIR, clean_cache_size=65536, 
+                 result_cache_size=0, result_cache_path=None, warmup=False, use_saved_model=True, 
+                 use_tflite=False, tflite_threads=None, expand_abbreviations=False, metrics=None, profiler=None, 
+                 max_length=None, window_overlap=16): 
+
+        from transformers import TFAutoModelForTokenClassification, BertConfig, AutoTokenizer, DataCollatorForTokenClassification
+        set_global_logging_level(logging.ERROR)
         
-        finetuned_bert2_dir = "/Users/peetal/Desktop/street-element-extraction/finetuned_bert2"
-        model_ckpt = "indobenchmark/indobert-base-p2" # specify model id 
-        self.tokenizer = AutoTokenizer.from_pretrained(model_ckpt) 
+        if os.path.exists(os.path.join(finetuned_bert2_dir, "tokenizer_config.json")): 
+            self.tokenizer = AutoTokenizer.from_pretrained(finetuned_bert2_dir, local_files_only=True)
+        else: 
+            self.tokenizer = AutoTokenizer.from_pretrained(MODEL_CKPT) 
         self.config = BertConfig.from_json_file(os.path.join(finetuned_bert2_dir,"config.json"))
-        self.model = TFAutoModelForTokenClassification.from_pretrained(os.path.join(finetuned_bert2_dir,"tf_model.h5"), config = self.config)
-
-    # for data cleaning 
-    def _clean(self, s):
-        res = re.sub(r'(\w)(\()(\w)', '\g<1> \g<2>\g<3>', s)
-        res = re.sub(r'(\w)([),.:;]+)(\w)', '\g<1>\g<2> \g<3>', res)
-        res = re.sub(r'(\w)(\.\()(\w)', '\g<1>. (\g<3>', res)
-        res = re.sub(r'\s+', ' ', res)
-        res = res.strip()
-        return res 
-
-    # tokenize the words
-    def _test_tokenization(self, batch): 
-        return self.tokenizer(batch['tokens'], is_split_into_words=True)
-
-    # get testw wrod id 
-    def _test_wordid(self, batch): 
-        tokenized_input = self.tokenizer(batch['tokens'], is_split_into_words=True)
-        batch_wordID = []
-        for idx, _ in enumerate(batch['input_ids']):
-            batch_wordID.append(tokenized_input.word_ids(batch_index = idx))
-        return batch_wordID
-
-    # use attention mask to remove padding and special tokens
-    def _masking(self, ids,labels, mask):
-        
-        # masking ids and labels using mask
-        masked_ids = np.ma.masked_where(mask==0,ids)
-        masked_ids = np.ma.compressed(masked_ids)
-
-        masked_labels = np.ma.masked_where(mask==0,labels)
-        masked_labels = np.ma.compressed(masked_labels)
-
-        return masked_ids, masked_labels
-
-    # align label and reconstruct tag
-    def _compress_tag(self, masked_labels, wordid): 
-        tag_compressed = []
-        for id in range(0, np.max([i for i in wordid if i is not None])+1):
-
-            # idx associated with the same word (across potentially multiple tokens)
-            id_idx = np.where(np.asarray(wordid) == id)[0]
-            id_tag = np.asarray(masked_labels)[id_idx]
-
-            # compress tag
-            poi = 0
-            street = 0
-            for t in id_tag: 
-                if t in ['B-POI','E-POI','S-POI','S-POI']:
-                    poi+= 1
-                elif t in ['B-STR','E-STR','S-STR','S-STR']:
-                    street+= 1
-            if poi == 0 and street == 0: 
-                tag_compressed.append("O")
-            elif poi > street: 
-                tag_compressed.append('POI')
-            elif street > poi: 
-                tag_compressed.append('STR')
-            elif street == poi: # street = poi != 0 
-                tag_compressed.append('POI/STR')
-        return tag_compressed 
-
-    # reconstruct tag
-    def _recon_compress_tag(self, tag_compressed): 
-
-        poi_idx = np.where(np.array(tag_compressed) == "POI")[0]
-        street_idx = np.where(np.array(tag_compressed) == "STR")[0]
-        if len(poi_idx) > 1: 
-            for i in range(poi_idx[0], poi_idx[-1]+1): 
-                tag_compressed[i] = "POI"
-        if len(street_idx) > 1: 
-            for i in range(street_idx[0], street_idx[-1]+1):
-                tag_compressed[i] = "STR" 
-        return tag_compressed
-    
-    def extract_element(self, raw_text): 
+        # the SavedModel written by export_savedmodel.py and the int8 model written by quantize_tflite.py 
+        # both return label ids directly; fall back to Keras predict without them.
+        # Both record the tf_model.h5 they were made from, so an export left over from before a retrain is never served
+        self.serving_fn = None
+        self.tflite_runner = None
+        self.model = None
+        weights_path = os.path.join(finetuned_bert2_dir,"tf_model.h5")
+        saved_model_dir = os.path.join(finetuned_bert2_dir, "saved_model")
+        tflite_path = os.path.join(finetuned_bert2_dir, "model_int8.tflite")
+        use_saved_model = use_saved_model and not use_tflite and os.path.isdir(saved_model_dir)
+        if use_saved_model and not exported_from(saved_model_dir, weights_path): 
+            warnings.warn(f"{saved_model_dir} was not exported from the current {weights_path}; using the Keras model. "
+                          f"Re-run export_savedmodel.py to serve the SavedModel again.")
+            use_saved_model = False
+        if use_tflite: 
+            if not exported_from(tflite_path, weights_path): 
+                raise ValueError(f"{tflite_path} was not quantized from the current {weights_path}; re-run quantize_tflite.py")
+            import tensorflow as tf
+            interpreter = tf.lite.Interpreter(model_path=tflite_path, num_threads=tflite_threads)
+            self.tflite_runner = interpreter.get_signature_runner("serving_default")
+            # identity of the artifact actually served, for the result cache
+            served_path = tflite_path
+        elif use_saved_model: 
+            import tensorflow as tf
+            self.serving_fn = tf.saved_model.load(saved_model_dir).signatures["serving_default"]
+            served_path = os.path.join(saved_model_dir, "saved_model.pb")
+        else: 
+            self.model = TFAutoModelForTokenClassification.from_pretrained(weights_path, config = self.config)
+            served_path = weights_path
+        self.data_collator = DataCollatorForTokenClassification(self.tokenizer, return_tensors="tf", padding = 'longest')
+        self.poi_table, self.str_table = vote_tables(self.config.id2label)
+        # longest sequence sent to the model, special tokens included; longer addresses are cut into word-aligned
+        # windows overlapping by window_overlap sub-words. Default: the model's position limit (512 for BERT)
+        self.max_length = min(max_length or self.config.max_position_embeddings, self.config.max_position_embeddings)
+        self.window_overlap = window_overlap
+        if not 0 <= window_overlap < self.max_length - 2: 
+            raise ValueError(f"window_overlap must be between 0 and max_length - 3, got {window_overlap} for max_length {self.max_length}")
+        self.last_padding_efficiency = None
+        # raw addresses repeat a lot, so cleaning goes through a bounded LRU cache unless disabled with 0/None
+        self._clean = make_cached_clean(clean_cache_size) if clean_cache_size else clean
+        # abbreviations.py's index, to write out abbreviated words (e.g. "angg" -> "anggrek") in the extracted elements
+        self.abbreviations = None
+        if expand_abbreviations: 
+            self.abbreviations = AbbreviationIndex.load(os.path.join(finetuned_bert2_dir, "abbreviations.npz"))
+        # optional cache of extracted elements, keyed on the cleaned address; result_cache.stats() has hit/miss counts
+        self.result_cache = None
+        if result_cache_size: 
+            # keyed on the artifact served: the int8 model gives slightly different results than the float one
+            cache_key = model_key(served_path)
+            if expand_abbreviations: 
+                cache_key += "+" + model_key(os.path.join(finetuned_bert2_dir, "abbreviations.npz"))
+            self.result_cache = PredictionCache(result_cache_size, path=result_cache_path, model_key=cache_key)
+        # instrumentation.PipelineMetrics for per-stage timings and row/token counters, 
+        # instrumentation.SlowRequestProfiler to keep profiles of the slowest extract_elements calls
+        self.metrics = metrics if metrics is not None else NULL_METRICS
+        self.profiler = profiler
+        if warmup: 
+            self.warmup()
 
-        # load test df
-        test_df = pd.DataFrame({"raw_address":[raw_text]})
-        test_df['raw_address'] = test_df['raw_address'].apply(lambda x: x.strip())
-        test_df['tokens'] = test_df['raw_address'].apply(self._clean).str.split()
-        test_df = test_df.drop(columns = ['raw_address'])
-        
-              
-        # prepare test tf set
-        ds_test = Dataset.from_pandas(test_df)
-        ds_test_encoded = ds_test.map(self._test_tokenization, batched = True)
-
-        data_collator = DataCollatorForTokenClassification(self.tokenizer, return_tensors="tf", padding = 'longest')
-        tf_test_dataset = ds_test_encoded.to_tf_dataset(
-            columns= ['input_ids', 'attention_mask'],
-            shuffle=False,
-            batch_size=512,
-            collate_fn=data_collator
-        )
-        
-        for batch in tf_test_dataset: 
-            # make prediction for this batch 
+    def warmup(self, batch_size=8): 
+        """
+        Run one dummy batch through the model so TensorFlow builds and traces it before the first real request.
+        Bypasses the result cache and the metrics.
+        """
+        metrics, self.metrics = self.metrics, NULL_METRICS
+        try: 
+            self._predict_tokens([["jalan", "raya", "no", "1"]] * batch_size, batch_size)
+        finally: 
+            self.metrics = metrics
+
+    def _predict_labels(self, input_ids, attention_mask): 
+        # padded forward pass: returns the label id matrix and the attention mask it was padded with
+        if self.serving_fn is not None or self.tflite_runner is not None: 
+            # pad to one of a few fixed lengths so the serving graph only ever sees a handful of shapes
+            with self.metrics.stage("pad"): 
+                seq_len = bucket_length(max(len(ids) for ids in input_ids))
+                mask = pad_rows(attention_mask, 0, seq_len)
+                ids = pad_rows(input_ids, self.tokenizer.pad_token_id, seq_len)
+            with self.metrics.stage("forward"): 
+                if self.tflite_runner is not None: 
+                    return self.tflite_runner(input_ids=ids, attention_mask=mask)["label_ids"], mask
+                import tensorflow as tf
+                pred_labels = self.serving_fn(input_ids=tf.constant(ids), attention_mask=tf.constant(mask))["label_ids"].numpy()
+            return pred_labels, mask
+
+        # pad this batch with the collator built in __init__
+        with self.metrics.stage("pad"): 
+            features = [{'input_ids': ids, 'attention_mask': mask} for ids, mask in zip(input_ids, attention_mask)]
+            batch = dict(self.data_collator(features))
+        with self.metrics.stage("forward"): 
             pred_logits = self.model.predict(batch)['logits']
-            pred_labels = np.argmax(pred_logits, axis=-1)
-
-            # id2tag 
-            pred_entity = []
-            for seq in list(pred_labels): 
-                entity = []
-                for l in seq: 
-                    entity.append(list(self.model.config.id2label.values())[l])
-                pred_entity.append(entity)
-            batch['pred_labels'] = np.array(pred_entity)
-
-            # to pandas
-            batch_df= Dataset.from_dict(batch).to_pandas()
-
-            # reconstruct street-related element for each row 
-            for _ ,row in batch_df.iterrows():
-                mask = row['attention_mask']
-                ids = row['input_ids']
-                labels = row['pred_labels']
-
-                # remove padding
-                masked_ids, masked_labels = self._masking(ids, labels, mask)
-                # convert ids to tokens 
-                masked_tokens = self.tokenizer.convert_ids_to_tokens(masked_ids)
-
-                # get word id for reconstructing tags
-                raw_string = self.tokenizer.decode(masked_ids)
-                raw_words = raw_string.split(" ")[1:-1]
-                wordid = self.tokenizer(raw_words,is_split_into_words=True).word_ids()
-
-                # reconstruct tokens into words, and compress tags accordingly. 
-                compressed_tag = self._compress_tag(masked_labels, wordid)
-                compressed_tag = self._recon_compress_tag(compressed_tag)
-                
-                street, poi = [],[]
-                for word, tag in zip(raw_words, compressed_tag): 
-                    if tag == "POI" or tag == "POI/STR":
-                        poi.append(word)
-                    elif tag == "STR" or tag == "POI/STR": 
-                        street.append(word)
-        street = " ".join(street)
-        poi = " ".join(poi)
-        return f"Raw address: {raw_text} \nStreet: {street} \nPOI: {poi}"
+        with self.metrics.stage("argmax"): 
+            pred_labels = argmax_labels(pred_logits)
+        return pred_labels, batch['attention_mask'].numpy()
+
+    def _predict_tokens(self, tokens, batch_size=512, max_tokens=None): 
+        # tokenize every address once
+        with self.metrics.stage("tokenize"): 
+            tokenized_inputs = self.tokenizer(tokens, is_split_into_words=True)
+            all_wordid = batch_word_ids(tokenized_inputs)
+
+        # addresses longer than max_length go in as several overlapping windows; batches are made of windows
+        with self.metrics.stage("batching"): 
+            window_ids, window_wordid, window_row = window_rows(tokenized_inputs['input_ids'], all_wordid, 
+                                                                self.max_length, self.window_overlap)
+            lengths = np.array([len(ids) for ids in window_ids])
+            if max_tokens is None: 
+                batches = fixed_batches(len(window_ids), batch_size)
+            else: 
+                batches = length_bucketed_batches(lengths, max_tokens, max_rows=batch_size)
+            self.last_padding_efficiency = padding_efficiency(lengths, batches)
+        self.metrics.count(windows=len(window_ids) - len(tokens))
+
+        # every word of every address gets a slot in one flat array; votes of all windows of an address add up there
+        n_words = np.array([len(words) for words in tokens], dtype=np.int64)
+        word_offsets = np.concatenate([[0], np.cumsum(n_words)[:-1]]).astype(np.int64)
+        poi_segments, str_segments = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]
+        for batch_idx in batches: 
+            # make prediction for this batch 
+            pred_labels, mask = self._predict_labels([window_ids[i] for i in batch_idx], 
+                                                     [[1] * len(window_ids[i]) for i in batch_idx])
+
+            n_tokens = int(mask.sum())
+            self.metrics.count(batches=1, tokens=n_tokens, padding_tokens=mask.size - n_tokens)
+
+            # word ids from the same tokenization, for reconstructing tags
+            with self.metrics.stage("masking"): 
+                wordid = word_id_matrix([window_wordid[i] for i in batch_idx], mask)
+
+            with self.metrics.stage("compress_recon"): 
+                batch_poi, batch_str = vote_segments(pred_labels, wordid, word_offsets[window_row[batch_idx]], 
+                                                     self.poi_table, self.str_table)
+                poi_segments.append(batch_poi)
+                str_segments.append(batch_str)
+
+        # compress sub-word votes into one tag per word, and reconstruct contiguous spans, for all addresses at once
+        with self.metrics.stage("compress_recon"): 
+            poi_votes = np.bincount(np.concatenate(poi_segments), minlength=n_words.sum())
+            str_votes = np.bincount(np.concatenate(str_segments), minlength=n_words.sum())
+            compressed_tag = recon_compress_tag(ragged_to_matrix(votes_to_tags(poi_votes, str_votes), n_words))
+            elements = []
+            for words, tags in zip(tokens, compressed_tag): 
+                street, poi = split_elements(words, tags)
+                elements.append({"street": " ".join(street), "poi": " ".join(poi)})
+
+        # one pass over the words of every address predicted here
+        if self.abbreviations is not None: 
+            with self.metrics.stage("expand_abbreviations"): 
+                self.abbreviations.expand_elements(elements)
+        return elements
+
+    def extract_elements(self, raw_texts, batch_size=512, max_tokens=None): 
+        """
+        Extract street and POI for a list of raw addresses.
+        Addresses that clean to the same text are predicted once, and previously seen ones come from the result cache if enabled.
+
+        Args:
+            - raw_texts: list of raw address strings
+            - batch_size: number of addresses per forward pass. Optional. Default is 512.
+            - max_tokens: if given, batch addresses of similar length under this padded-token budget 
+              (at most batch_size rows each) instead of in input order. Optional. Default is None.
+
+        Returns:
+            list of {"street": str, "poi": str}, one per input address, in input order.
+        """
+        if self.profiler is None: 
+            return self._extract_elements(raw_texts, batch_size, max_tokens)
+        with self.profiler.request(len(raw_texts)): 
+            return self._extract_elements(raw_texts, batch_size, max_tokens)
+
+    def _extract_elements(self, raw_texts, batch_size, max_tokens): 
+        # clean every address; the cleaned text (tokens joined by single spaces) is the dedup / cache key
+        with self.metrics.stage("clean"): 
+            cleaned = clean_many([raw_text.strip() for raw_text in raw_texts], self._clean)
+            distinct = list(dict.fromkeys(cleaned))
+
+        with self.metrics.stage("cache"): 
+            found = self.result_cache.get_many(distinct) if self.result_cache is not None else {}
+        to_predict = [key for key in distinct if key not in found]
+        self.metrics.count(requests=1, rows=len(raw_texts), distinct_rows=len(distinct), predicted_rows=len(to_predict))
+        if len(to_predict) > 0: 
+            predicted = dict(zip(to_predict, self._predict_tokens([key.split() for key in to_predict], batch_size, max_tokens)))
+            if self.result_cache is not None: 
+                with self.metrics.stage("cache"): 
+                    self.result_cache.put_many(predicted)
+            found.update(predicted)
+
+        # fan the distinct results back out to every input row
+        return [dict(found[key]) for key in cleaned]
+
+    def extract_element(self, raw_text): 
+        element = self.extract_elements([raw_text])[0]
+        return f"Raw address: {raw_text} \nStreet: {element['street']} \nPOI: {element['poi']}"
 
 if __name__ == "__main__":
 
-    model = AddressElementExtract()
+    parser = argparse.ArgumentParser(description='Extract street and POI from a raw address')
+    parser.add_argument(
+        '--address',
+        required=True,
+        action='store',
+        help='raw address')
+    parser.add_argument('--model_dir', default=DEFAULT_MODEL_DIR, help='fine-tuned model directory or exported bundle')
+    parser.add_argument('--expand_abbreviations', action='store_true', help='expand abbreviated words with <model_dir>/abbreviations.npz')
+    args = parser.parse_args()
+
+    model = AddressElementExtract(args.model_dir, expand_abbreviations=args.expand_abbreviations)
     elements = model.extract_element(args.address)
-    print(elements)
\ No newline at end of file
+    print(elements)
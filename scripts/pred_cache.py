@@ -0,0 +1,130 @@
+import os, json, sqlite3
+from collections import OrderedDict
+
+
+class PredictionCache():
+    """
+    Size-bounded cache of extracted elements, keyed on the cleaned address (its tokens joined by single spaces).
+
+    Lookups go to an in-memory LRU first and, if `path` is given, to a local SQLite file that survives restarts.
+    Both layers hold at most `maxsize` entries; memory evicts the least recently used entry,
+    disk the least recently written one.
+    `model_key` identifies the model that produced the entries: a disk cache written by another model is wiped.
+    """
+
+    def __init__(self, maxsize=100000, path=None, model_key=""):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._db = None
+        if path is not None:
+            # the cache may be built in one thread and used from another (e.g. serve.py's batching thread)
+            self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS elements (key TEXT PRIMARY KEY, street TEXT, poi TEXT)")
+            row = self._db.execute("SELECT value FROM meta WHERE name = 'model_key'").fetchone()
+            if row is None or row[0] != model_key:
+                self._db.execute("DELETE FROM elements")
+                self._db.execute("INSERT OR REPLACE INTO meta VALUES ('model_key', ?)", (model_key,))
+            self._db.commit()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remember(self, key, element):
+        self._entries[key] = element
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def get_many(self, keys):
+        """
+        Look up distinct keys; returns {key: element} for the hits and counts hits/misses.
+        """
+        found = {}
+        missing = []
+        for key in keys:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                found[key] = self._entries[key]
+            else:
+                missing.append(key)
+
+        if self._db is not None and len(missing) > 0:
+            # sqlite caps the number of bound parameters per statement
+            for start in range(0, len(missing), 500):
+                part = missing[start:start+500]
+                rows = self._db.execute(
+                    f"SELECT key, street, poi FROM elements WHERE key IN ({','.join('?' * len(part))})", part).fetchall()
+                for key, street, poi in rows:
+                    found[key] = {"street": street, "poi": poi}
+                    self._remember(key, found[key])
+
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, elements):
+        """
+        Store {key: element} for freshly predicted keys.
+        """
+        for key, element in elements.items():
+            self._remember(key, element)
+
+        if self._db is not None and len(elements) > 0:
+            self._db.executemany("INSERT OR REPLACE INTO elements VALUES (?, ?, ?)",
+                                 [(key, e["street"], e["poi"]) for key, e in elements.items()])
+            # INSERT OR REPLACE gives a fresh rowid, so the lowest rowids are the least recently written
+            self._db.execute("DELETE FROM elements WHERE rowid IN "
+                             "(SELECT rowid FROM elements ORDER BY rowid LIMIT max(0, (SELECT count(*) FROM elements) - ?))",
+                             (self.maxsize,))
+            self._db.commit()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries),
+                "hit_rate": self.hits / lookups if lookups > 0 else 0.0}
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+def model_key(weights_path):
+    """
+    Cheap identity of a weights file (path, size, mtime), to tell when a disk cache is stale.
+    """
+    stat = os.stat(weights_path)
+    return f"{os.path.abspath(weights_path)}:{stat.st_size}:{int(stat.st_mtime)}"
+
+
+# exported models (saved_model/, model_int8.tflite) record which tf_model.h5 they were made from, so a retrain
+# that replaces tf_model.h5 is noticed instead of the old export being served
+def weights_key(weights_path):
+    """
+    Identity of a weights file without its path (size, mtime in ns), so a model directory can be moved.
+    """
+    stat = os.stat(weights_path)
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+def source_record_path(artifact_path):
+    # saved_model/source.json for a directory, model_int8.tflite.source.json for a file
+    if os.path.isdir(artifact_path):
+        return os.path.join(artifact_path, "source.json")
+    return artifact_path + ".source.json"
+
+def write_source_record(artifact_path, weights_path):
+    with open(source_record_path(artifact_path), 'w') as f:
+        json.dump({"weights": os.path.basename(weights_path), "weights_key": weights_key(weights_path)}, f)
+
+def exported_from(artifact_path, weights_path):
+    """
+    Whether `artifact_path` was exported from the current `weights_path`; False if it has no source record.
+    """
+    record_path = source_record_path(artifact_path)
+    if not os.path.exists(record_path):
+        return False
+    with open(record_path) as f:
+        return json.load(f).get("weights_key") == weights_key(weights_path)
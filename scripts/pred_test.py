@@ -1,160 +1,189 @@
-from string import punctuation
-import re, os
-from transformers import TFAutoModelForTokenClassification, PretrainedConfig, BertConfig, AutoTokenizer, DataCollatorForTokenClassification
-from collections import defaultdict
-import numpy as np 
+import os, json, time, threading
+import argparse
+import multiprocessing
+from collections import deque
 import pandas as pd
-from datasets import Dataset
-
-def clean(s):
-    res = re.sub(r'(\w)(\()(\w)', '\g<1> \g<2>\g<3>', s)
-    res = re.sub(r'(\w)([),.:;]+)(\w)', '\g<1>\g<2> \g<3>', res)
-    res = re.sub(r'(\w)(\.\()(\w)', '\g<1>. (\g<3>', res)
-    res = re.sub(r'\s+', ' ', res)
-    res = res.strip()
-    return res
-
-def test_tokenization(batch): 
-    return tokenizer(batch['tokens'], is_split_into_words=True)
-
-def test_wordid(batch): 
-    tokenized_input = tokenizer(batch['tokens'], is_split_into_words=True)
-    batch_wordID = []
-    for idx, _ in enumerate(batch['input_ids']):
-        batch_wordID.append(tokenized_input.word_ids(batch_index = idx))
-    return batch_wordID
-
-def masking(ids,labels, mask):
-    
-    # masking ids and labels using mask
-    masked_ids = np.ma.masked_where(mask==0,ids)
-    masked_ids = np.ma.compressed(masked_ids)
-
-    masked_labels = np.ma.masked_where(mask==0,labels)
-    masked_labels = np.ma.compressed(masked_labels)
-
-    return masked_ids, masked_labels
-
-def compress_tag(masked_labels, wordid): 
-    tag_compressed = []
-    for id in range(0, np.max([i for i in wordid if i is not None])+1):
-
-        # idx associated with the same word (across potentially multiple tokens)
-        id_idx = np.where(np.asarray(wordid) == id)[0]
-        id_tag = np.asarray(masked_labels)[id_idx]
-
-        # compress tag
-        poi = 0
-        street = 0
-        for t in id_tag: 
-            if t in ['B-POI','E-POI','S-POI','S-POI']:
-                poi+= 1
-            elif t in ['B-STR','E-STR','S-STR','S-STR']:
-                street+= 1
-        if poi == 0 and street == 0: 
-            tag_compressed.append("O")
-        elif poi > street: 
-            tag_compressed.append('POI')
-        elif street > poi: 
-            tag_compressed.append('STR')
-        elif street == poi: # street = poi != 0 
-            tag_compressed.append('POI/STR')
-    return tag_compressed 
-
-def recon_compress_tag(tag_compressed): 
-
-    poi_idx = np.where(np.array(tag_compressed) == "POI")[0]
-    street_idx = np.where(np.array(tag_compressed) == "STR")[0]
-    if len(poi_idx) > 1: 
-        for i in range(poi_idx[0], poi_idx[-1]+1): 
-            tag_compressed[i] = "POI"
-    if len(street_idx) > 1: 
-        for i in range(street_idx[0], street_idx[-1]+1):
-            tag_compressed[i] = "STR" 
-    
-    return tag_compressed
+from pred import AddressElementExtract, set_tf_threads
+
+
+# progress of a (possibly interrupted) run is kept next to the output file
+def progress_path(output_path): 
+    return output_path + ".progress"
+
+def read_progress(output_path): 
+    if not os.path.exists(progress_path(output_path)): 
+        return {"rows": 0, "bytes": 0}
+    with open(progress_path(output_path)) as f: 
+        return json.load(f)
+
+def write_progress(output_path, rows, n_bytes): 
+    # write then rename, so a crash never leaves a half-written progress file
+    tmp_path = progress_path(output_path) + ".tmp"
+    with open(tmp_path, 'w') as f: 
+        json.dump({"rows": rows, "bytes": n_bytes}, f)
+    os.replace(tmp_path, progress_path(output_path))
+
+
+# each worker process loads its own model once, in the pool initializer
+_worker_extractor = None
+
+def init_worker(model_dir, intra_op_threads, inter_op_threads, cache_size=0, cache_path=None, use_tflite=False, 
+                expand_abbreviations=False, max_length=None, window_overlap=16): 
+    global _worker_extractor
+    set_tf_threads(intra_op_threads, inter_op_threads)
+    _worker_extractor = AddressElementExtract(model_dir, result_cache_size=cache_size, result_cache_path=cache_path, 
+                                              use_tflite=use_tflite, tflite_threads=intra_op_threads or None, 
+                                              expand_abbreviations=expand_abbreviations, 
+                                              max_length=max_length, window_overlap=window_overlap)
+
+def extract_shard(shard): 
+    raw_texts, batch_size, max_tokens = shard
+    return _worker_extractor.extract_elements(raw_texts, batch_size=batch_size, max_tokens=max_tokens)
+
+
+def pool_chunk_elements(reader, pool, n_shards, batch_size, max_tokens, max_pending_chunks=2): 
+    """
+    Yield (ids, elements) for every chunk of `reader`, in order, predicted by a worker `pool` (see init_worker).
+
+    Each chunk is split into `n_shards` shards and one pool.imap runs over the shards of all chunks, so the next
+    chunk's shards are already queued while the current one drains and while its results are written out.
+    At most `max_pending_chunks` chunks are read ahead, which bounds memory.
+    """
+    pending = deque()  # (ids, number of shards) of every chunk whose shards are queued, oldest first
+    slots = threading.Semaphore(max_pending_chunks)
+    stop = threading.Event()
+
+    # consumed by the pool's task-handler thread, which blocks here while max_pending_chunks chunks are in flight
+    def shards(): 
+        for chunk in reader: 
+            while not slots.acquire(timeout=0.1): 
+                if stop.is_set(): 
+                    return
+            raw_texts = chunk['raw_address'].tolist()
+            shard_size = max(1, -(-len(raw_texts) // n_shards))
+            chunk_shards = [(raw_texts[i:i+shard_size], batch_size, max_tokens) for i in range(0, len(raw_texts), shard_size)]
+            pending.append((chunk['id'].values, len(chunk_shards)))
+            yield from chunk_shards
+
+    try: 
+        # imap hands shards back in submission order, so chunks and rows stay in input order
+        elements, shards_done = [], 0
+        for shard_elements in pool.imap(extract_shard, shards()): 
+            elements.extend(shard_elements)
+            shards_done += 1
+            if shards_done == pending[0][1]: 
+                ids, _ = pending.popleft()
+                yield ids, elements
+                elements, shards_done = [], 0
+                slots.release()
+    finally: 
+        # let the shard generator finish if we stop early (an error, or the consumer closing us)
+        stop.set()
+
+
+def predict_csv(extractor, input_path, output_path, chunk_size=50000, batch_size=512, max_tokens=None, pool=None, n_shards=1): 
+    """
+    Stream `input_path` (columns id, raw_address) to `output_path` (columns id, POI/street) chunk by chunk.
+
+    Each chunk is appended to the output as soon as it is predicted, so memory stays bounded by the chunk size.
+    If a previous run was interrupted, the output is cut back to the last completed chunk and the run resumes from there.
+    With a worker `pool` (see init_worker), each chunk is split into `n_shards` shards predicted in parallel, 
+    the next chunk being queued while the current one finishes (see pool_chunk_elements); `extractor` is not used.
+    """
+    progress = read_progress(output_path)
+    if progress["rows"] > 0 and os.path.exists(output_path): 
+        # drop anything written after the last recorded chunk
+        with open(output_path, 'r+') as f: 
+            f.truncate(progress["bytes"])
+        print(f"resuming after {progress['rows']} rows")
+    else: 
+        progress = {"rows": 0, "bytes": 0}
+        pd.DataFrame(columns=['id', 'POI/street']).to_csv(output_path, index=False)
+
+    reader = pd.read_csv(input_path, chunksize=chunk_size, skiprows=range(1, progress["rows"] + 1),
+                         dtype={'raw_address': str}, keep_default_na=False)
+    if pool is None: 
+        # clean -> tokenize -> predict -> reconstruct for one chunk at a time
+        chunk_elements = ((chunk['id'].values, extractor.extract_elements(chunk['raw_address'].tolist(), batch_size=batch_size, 
+                                                                          max_tokens=max_tokens))
+                          for chunk in reader)
+    else: 
+        chunk_elements = pool_chunk_elements(reader, pool, n_shards, batch_size, max_tokens)
+
+    rows_done = progress["rows"]
+    start_time = time.time()
+    for ids, elements in chunk_elements: 
+        output_df = pd.DataFrame({'id': ids, 
+                                  'POI/street': [e['poi'] + "/" + e['street'] for e in elements]})
+        output_df.to_csv(output_path, mode='a', header=False, index=False)
+
+        rows_done += len(ids)
+        write_progress(output_path, rows_done, os.path.getsize(output_path))
+        elapsed = time.time() - start_time
+        start_time = time.time()
+        message = f"{rows_done} rows done, {len(ids) / elapsed:.1f} rows/sec"
+        if pool is None: 
+            if extractor.last_padding_efficiency is not None: 
+                message += f", padding efficiency: {extractor.last_padding_efficiency:.3f}"
+            if extractor.result_cache is not None: 
+                message += ", cache hit rate: {hit_rate:.3f}".format(**extractor.result_cache.stats())
+        print(message)
+
+    # finished: a rerun should start over rather than resume
+    if os.path.exists(progress_path(output_path)): 
+        os.remove(progress_path(output_path))
+    return rows_done
 
 
 if __name__ == "__main__":
-    
-    # load test df
-    test_df = pd.read_csv('test.csv')
-    test_df['raw_address'] = test_df['raw_address'].apply(lambda x: x.strip())
-    test_df['tokens'] = test_df['raw_address'].apply(clean).str.split()
-    test_df = test_df.drop(columns = ['raw_address'])
-    #test_df = test_df.head(1000)
-    
-    model_ckpt = "indobenchmark/indobert-base-p2" # specify model id 
-    tokenizer = AutoTokenizer.from_pretrained(model_ckpt) 
-    
-    # prepare test tf set
-    ds_test = Dataset.from_pandas(test_df)
-    ds_test_encoded = ds_test.map(test_tokenization, batched = True)
-
-    data_collator = DataCollatorForTokenClassification(tokenizer, return_tensors="tf", padding = 'longest')
-    tf_test_dataset = ds_test_encoded.to_tf_dataset(
-        columns= ['input_ids', 'attention_mask'],
-        shuffle=False,
-        batch_size=512,
-        collate_fn=data_collator
-    )
-    
-    # load model: 
-    finetuned_bert2_dir = "/home/peetal/hulacon/street-element-extraction/finetuned_bert2/"
-    # load back model 
-    config = BertConfig.from_json_file(os.path.join(finetuned_bert2_dir,"config.json"))
-    model =  TFAutoModelForTokenClassification.from_pretrained(os.path.join(finetuned_bert2_dir,"tf_model.h5"), config = config)
-    
-    pred_NE = defaultdict(list)
-    for batch in tf_test_dataset: 
-        # make prediction for this batch 
-        pred_logits = model.predict(batch)['logits']
-        pred_labels = np.argmax(pred_logits, axis=-1)
-
-        # id2tag 
-        pred_entity = []
-        for seq in list(pred_labels): 
-            entity = []
-            for l in seq: 
-                entity.append(list(model.config.id2label.values())[l])
-            pred_entity.append(entity)
-        batch['pred_labels'] = np.array(pred_entity)
-
-        # to pandas
-        batch_df= Dataset.from_dict(batch).to_pandas()
-
-        # reconstruct street-related element for each row 
-        for _ ,row in batch_df.iterrows():
-            mask = row['attention_mask']
-            ids = row['input_ids']
-            labels = row['pred_labels']
-
-            # remove padding
-            masked_ids, masked_labels = masking(ids, labels, mask)
-            # convert ids to tokens 
-            masked_tokens = tokenizer.convert_ids_to_tokens(masked_ids)
-
-            # get word id for reconstructing tags
-            raw_string = tokenizer.decode(masked_ids)
-            raw_words = raw_string.split(" ")[1:-1]
-            wordid = tokenizer(raw_words,is_split_into_words=True).word_ids()
-
-            # reconstruct tokens into words, and compress tags accordingly. 
-            compressed_tag = compress_tag(masked_labels, wordid)
-            compressed_tag = recon_compress_tag(compressed_tag)
-            #print(compressed_tag)
-            street, poi = [],[]
-            for word, tag in zip(raw_words, compressed_tag): 
-                if tag == "POI" or tag == "POI/STR":
-                    poi.append(word)
-                elif tag == "STR" or tag == "POI/STR": 
-                    street.append(word)
-            pred_NE['POI/street'].append(" ".join(poi) + "/" + " ".join(street))
-            
-            
-    # output file 
-    pred_NE['id'] = list(range(len(pred_NE['POI/street'])))
-    output_df = pd.DataFrame(pred_NE)
-    output_df = output_df[['id', 'POI/street']]
-    output_df.to_csv(os.path.join(finetuned_bert2_dir,"pred.csv"), index = False)
-    
\ No newline at end of file
+
+    parser = argparse.ArgumentParser(description='Predict street and POI for every address in a csv of raw addresses')
+    parser.add_argument('--input', required=True, help='input csv with columns id, raw_address')
+    parser.add_argument('--output', required=True, help='output csv with columns id, POI/street')
+    parser.add_argument('--model_dir', required=True, help='directory holding the fine-tuned config.json and tf_model.h5')
+    parser.add_argument('--chunk_size', type=int, default=50000, help='rows read, predicted and written at a time')
+    parser.add_argument('--batch_size', type=int, default=512, help='rows per batch (max rows per batch when bucketing)')
+    parser.add_argument('--bucket_by_length', action='store_true', help='sort rows by sub-word length and batch by a token budget')
+    parser.add_argument('--max_tokens', type=int, default=16384, help='padded tokens per batch when bucketing')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes, each with its own model')
+    parser.add_argument('--intra_op_threads', type=int, default=None, 
+                        help='TensorFlow intra-op threads per worker. Default: all cores for one worker, cores / workers otherwise')
+    parser.add_argument('--inter_op_threads', type=int, default=None, 
+                        help='TensorFlow inter-op threads per worker. Default: TensorFlow default for one worker, 1 otherwise')
+    parser.add_argument('--cache_size', type=int, default=0, help='cache this many extracted addresses (per worker); 0 disables the cache')
+    parser.add_argument('--cache_path', default=None, help='sqlite file to persist the cache across runs')
+    parser.add_argument('--tflite', action='store_true', help='run the int8 model_int8.tflite written by quantize_tflite.py')
+    parser.add_argument('--expand_abbreviations', action='store_true', help='expand abbreviated words with <model_dir>/abbreviations.npz')
+    parser.add_argument('--max_length', type=int, default=None, 
+                        help='max sub-words per sequence (e.g. 64 or 128); longer addresses are split into overlapping windows')
+    parser.add_argument('--window_overlap', type=int, default=16, help='sub-words shared by consecutive windows')
+    args = parser.parse_args()
+
+    # split the cores between workers so they don't oversubscribe
+    intra_op_threads = args.intra_op_threads
+    inter_op_threads = args.inter_op_threads
+    if intra_op_threads is None: 
+        intra_op_threads = 0 if args.workers == 1 else max(1, os.cpu_count() // args.workers)
+    if inter_op_threads is None: 
+        inter_op_threads = 0 if args.workers == 1 else 1
+    max_tokens = args.max_tokens if args.bucket_by_length else None
+
+    start_time = time.time()
+    if args.workers == 1: 
+        set_tf_threads(intra_op_threads, inter_op_threads)
+        extractor = AddressElementExtract(args.model_dir, result_cache_size=args.cache_size, result_cache_path=args.cache_path, 
+                                          use_tflite=args.tflite, tflite_threads=intra_op_threads or None, 
+                                          expand_abbreviations=args.expand_abbreviations, 
+                                          max_length=args.max_length, window_overlap=args.window_overlap)
+        n_rows = predict_csv(extractor, args.input, args.output, chunk_size=args.chunk_size, batch_size=args.batch_size, 
+                             max_tokens=max_tokens)
+    else: 
+        # spawn, not fork: TensorFlow is not fork-safe once initialised
+        ctx = multiprocessing.get_context('spawn')
+        initargs = (args.model_dir, intra_op_threads, inter_op_threads, args.cache_size, args.cache_path, args.tflite, 
+                    args.expand_abbreviations, args.max_length, args.window_overlap)
+        with ctx.Pool(args.workers, initializer=init_worker, initargs=initargs) as pool: 
+            # a few shards per worker, so one worker's tokenization/reconstruction overlaps another's forward pass
+            n_rows = predict_csv(None, args.input, args.output, chunk_size=args.chunk_size, batch_size=args.batch_size, 
+                                 max_tokens=max_tokens, pool=pool, n_shards=4 * args.workers)
+    print(f"{n_rows} rows written to {args.output} in {time.time() - start_time:.1f}s")
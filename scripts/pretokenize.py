@@ -0,0 +1,175 @@
+import os, json, hashlib
+import argparse, ast
+import numpy as np
+import pandas as pd
+from batching import fixed_batches, length_bucketed_batches, bucket_length
+
+# One-time encoding of train_df_pretokenization.csv into flat NumPy arrays that training and evaluation memory-map:
+#   input_ids.npy / labels.npy  all rows' sub-word ids and aligned label ids, concatenated
+#   word_ids.npy                word index of every sub-word in its address, -1 for special tokens
+#   offsets.npy                 row i is input_ids[offsets[i]:offsets[i+1]]
+#   train_rows.npy / test_rows.npy  row order of each split, as shuffle(seed=42).train_test_split(0.15) returns it
+#   meta.json                   hashes of the csv and tokenizer the arrays were built from
+ARRAYS = ['input_ids', 'labels', 'word_ids', 'offsets', 'train_rows', 'test_rows']
+
+
+def file_sha256(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def tokenizer_sha256(tokenizer):
+    # the fast tokenizer's full serialisation (vocab, normalizer, special tokens) changes whenever its output could
+    if getattr(tokenizer, 'is_fast', False):
+        return hashlib.sha256(tokenizer.backend_tokenizer.to_str().encode('utf-8')).hexdigest()
+    return hashlib.sha256(json.dumps(sorted(tokenizer.get_vocab().items())).encode('utf-8')).hexdigest()
+
+
+def build_cache(csv_path, tokenizer, cache_dir, test_size=0.15, seed=42):
+    from datasets import Dataset
+    from finetune_bert import encode_dataset
+
+    # tokenization and align lables to sub-words, as finetune_bert.py does
+    df_converters = {'tokens': ast.literal_eval, 'labels': ast.literal_eval}
+    df = pd.read_csv(csv_path, converters=df_converters)
+    df = df.rename(columns={"labels": "tags"})
+    ds_encoded = encode_dataset(Dataset.from_pandas(df), tokenizer)
+
+    # split with datasets itself and record which rows ended up where, in order.
+    # train_test_split gets a seed too: without one it draws from numpy's global RNG and every run splits differently
+    ds_encoded = ds_encoded.add_column('row', np.arange(len(ds_encoded)))
+    processed_dataset = ds_encoded.shuffle(seed=seed).train_test_split(test_size=test_size, seed=seed)
+
+    lengths = np.array([len(ids) for ids in ds_encoded['input_ids']])
+    arrays = {
+        'input_ids': np.fromiter((i for ids in ds_encoded['input_ids'] for i in ids), dtype=np.int32, count=lengths.sum()),
+        'labels': np.fromiter((l for labels in ds_encoded['labels'] for l in labels), dtype=np.int8, count=lengths.sum()),
+        'word_ids': np.fromiter((w for word_ids in ds_encoded['word_ids'] for w in word_ids), dtype=np.int16, count=lengths.sum()),
+        'offsets': np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64),
+        'train_rows': np.array(processed_dataset['train']['row'], dtype=np.int64),
+        'test_rows': np.array(processed_dataset['test']['row'], dtype=np.int64),
+    }
+
+    os.makedirs(cache_dir, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(cache_dir, name + '.npy'), array)
+    meta = {'source_sha256': file_sha256(csv_path), 'tokenizer_sha256': tokenizer_sha256(tokenizer),
+            'pad_token_id': tokenizer.pad_token_id, 'n_rows': len(lengths), 'test_size': test_size, 'seed': seed}
+    # meta.json last: a cache without it is incomplete and gets rebuilt
+    with open(os.path.join(cache_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    return meta
+
+
+def load_cache(cache_dir):
+    """
+    Memory-map the arrays of a cache written by build_cache; returns (meta, {name: array}).
+    """
+    with open(os.path.join(cache_dir, 'meta.json')) as f:
+        meta = json.load(f)
+    arrays = {name: np.load(os.path.join(cache_dir, name + '.npy'), mmap_mode='r') for name in ARRAYS}
+    return meta, arrays
+
+
+def is_fresh(cache_dir, csv_path, tokenizer, test_size=0.15, seed=42):
+    meta_path = os.path.join(cache_dir, 'meta.json')
+    if not os.path.exists(meta_path):
+        return False
+    # caches written before an array was added are rebuilt too
+    if not all(os.path.exists(os.path.join(cache_dir, name + '.npy')) for name in ARRAYS):
+        return False
+    with open(meta_path) as f:
+        meta = json.load(f)
+    return (meta['source_sha256'] == file_sha256(csv_path) and meta['tokenizer_sha256'] == tokenizer_sha256(tokenizer)
+            and meta['test_size'] == test_size and meta['seed'] == seed)
+
+
+def load_or_build_cache(csv_path, tokenizer, cache_dir, test_size=0.15, seed=42):
+    if not is_fresh(cache_dir, csv_path, tokenizer, test_size, seed):
+        print(f"building pre-tokenized cache in {cache_dir}")
+        build_cache(csv_path, tokenizer, cache_dir, test_size, seed)
+    return load_cache(cache_dir)
+
+
+def split_batch_rows(arrays, split, batch_size, max_tokens=None):
+    """
+    Row ids of each batch of one split: consecutive rows in the split's order, or with `max_tokens`
+    rows of similar length under that padded-token budget (at most batch_size rows each).
+    """
+    rows = np.asarray(arrays[split + '_rows'])
+    if max_tokens is None:
+        return [rows[batch_idx] for batch_idx in fixed_batches(len(rows), batch_size)]
+    offsets = arrays['offsets']
+    lengths = offsets[rows + 1] - offsets[rows]
+    return [rows[batch_idx] for batch_idx in length_bucketed_batches(lengths, max_tokens, max_rows=batch_size)]
+
+
+def split_batches(arrays, batches, pad_token_id, pad_to_buckets=False, with_word_ids=False):
+    """
+    Padded batches of the given row ids, shaped like DataCollatorForTokenClassification's output.
+    With `pad_to_buckets`, batches are padded up to one of batching.SEQ_BUCKETS lengths.
+    With `with_word_ids`, batches also carry 'word_ids' (-1 for special tokens and padding), which is not a model input.
+    """
+    offsets = arrays['offsets']
+    for batch_rows in batches:
+        starts = offsets[batch_rows]
+        lengths = offsets[batch_rows + 1] - starts
+        seq_len = lengths.max()
+        positions = np.arange(bucket_length(seq_len) if pad_to_buckets else seq_len)
+        attention_mask = positions < lengths[:, None]
+
+        # gather every row's tokens from the flat arrays with one fancy index
+        flat_idx = (starts[:, None] + positions)[attention_mask]
+        input_ids = np.full(attention_mask.shape, pad_token_id, dtype=np.int32)
+        labels = np.full(attention_mask.shape, -100, dtype=np.int32)
+        input_ids[attention_mask] = arrays['input_ids'][flat_idx]
+        labels[attention_mask] = arrays['labels'][flat_idx]
+        batch = {'input_ids': input_ids, 'token_type_ids': np.zeros_like(input_ids),
+                 'attention_mask': attention_mask.astype(np.int32), 'labels': labels}
+        if with_word_ids:
+            batch['word_ids'] = np.full(attention_mask.shape, -1, dtype=np.int32)
+            batch['word_ids'][attention_mask] = arrays['word_ids'][flat_idx]
+        yield batch
+
+
+def to_tf_dataset(arrays, split, batch_size, pad_token_id, max_tokens=None, shuffle_seed=None, pad_to_buckets=False,
+                  with_word_ids=False):
+    """
+    tf.data pipeline over one split. With `max_tokens`, batches group rows of similar length (see split_batch_rows);
+    with `shuffle_seed`, the batch order is reshuffled every epoch so training doesn't see them sorted by length.
+    `pad_to_buckets` keeps the number of distinct batch shapes small, e.g. so XLA doesn't recompile for every length.
+    """
+    import tensorflow as tf
+    batches = split_batch_rows(arrays, split, batch_size, max_tokens)
+    rng = np.random.default_rng(shuffle_seed)
+
+    def epoch_batches():
+        order = rng.permutation(len(batches)) if shuffle_seed is not None else range(len(batches))
+        return split_batches(arrays, [batches[i] for i in order], pad_token_id, pad_to_buckets, with_word_ids)
+
+    spec = tf.TensorSpec([None, None], tf.int32)
+    names = ['input_ids', 'token_type_ids', 'attention_mask', 'labels'] + (['word_ids'] if with_word_ids else [])
+    tf_dataset = tf.data.Dataset.from_generator(epoch_batches, output_signature={name: spec for name in names})
+    # from_generator has unknown length; callers use len() to size the lr schedule
+    return tf_dataset.apply(tf.data.experimental.assert_cardinality(len(batches)))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Encode the labelled csv once into memory-mapped arrays for training and evaluation')
+    parser.add_argument('--data_csv', default="train_df_pretokenization.csv", help='labelled csv written by the preprocessing step')
+    parser.add_argument('--tokenizer', default="indobenchmark/indobert-base-p2", help='hub id or local directory of the tokenizer')
+    parser.add_argument('--cache_dir', default="pretokenized", help='directory to write the arrays to')
+    parser.add_argument('--force', action='store_true', help='rebuild even if the cache matches the csv and tokenizer')
+    args = parser.parse_args()
+
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    if args.force or not is_fresh(args.cache_dir, args.data_csv, tokenizer):
+        meta = build_cache(args.data_csv, tokenizer, args.cache_dir)
+        print(f"wrote {meta['n_rows']} rows to {args.cache_dir}")
+    else:
+        print(f"{args.cache_dir} is up to date")
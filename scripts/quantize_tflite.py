@@ -0,0 +1,74 @@
+import os, time, tempfile
+import argparse
+import numpy as np
+import tensorflow as tf
+from transformers import TFAutoModelForTokenClassification, BertConfig
+from export_savedmodel import export_savedmodel
+from pred_cache import write_source_record
+import eval_validateset
+
+
+# int8 dynamic-range quantization: weights stored as int8, activations stay float
+def quantize_tflite(saved_model_dir, output_path): 
+    converter = tf.lite.TFLiteConverter.from_saved_model(saved_model_dir, signature_keys=["serving_default"])
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    # a few BERT ops (e.g. erf in gelu) may have no TFLite builtin; let them run as TF ops
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+    with open(output_path, 'wb') as f: 
+        f.write(converter.convert())
+    return output_path
+
+def tflite_predict_fn(tflite_path, num_threads=None): 
+    # label ids for a collated batch, through the quantized model's serving signature
+    runner = tf.lite.Interpreter(model_path=tflite_path, num_threads=num_threads).get_signature_runner("serving_default")
+    def predict_fn(batch): 
+        return runner(input_ids=np.asarray(batch["input_ids"], dtype=np.int32), 
+                      attention_mask=np.asarray(batch["attention_mask"], dtype=np.int32))["label_ids"]
+    return predict_fn
+
+def timed_evaluate(model, dataset, ner_labels, predict_fn=None): 
+    start_time = time.perf_counter()
+    results = eval_validateset.evaluate(model, dataset, ner_labels, predict_fn=predict_fn)
+    return results, time.perf_counter() - start_time
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Quantize the fine-tuned model to int8 TFLite and gate it on validation F1')
+    parser.add_argument('--model_dir', required=True, help='directory holding the fine-tuned config.json and tf_model.h5')
+    parser.add_argument('--output', default=None, help='tflite file. Default: <model_dir>/model_int8.tflite, which pred.py picks up')
+    parser.add_argument('--eval_csv', default=None, help='train_df_pretokenization.csv; if given, compare F1 and speed on the validation split')
+    parser.add_argument('--max_f1_drop', type=float, default=0.01, help='fail if overall F1 drops by more than this')
+    args = parser.parse_args()
+
+    weights_path = os.path.join(args.model_dir,"tf_model.h5")
+    config = BertConfig.from_json_file(os.path.join(args.model_dir,"config.json"))
+    model = TFAutoModelForTokenClassification.from_pretrained(weights_path, config = config)
+
+    # convert from the model just loaded, never from a saved_model/ that may predate the current tf_model.h5,
+    # so the int8 file and the fp32 baseline below are the same model
+    output_path = args.output or os.path.join(args.model_dir, "model_int8.tflite")
+    with tempfile.TemporaryDirectory() as tmp_dir: 
+        quantize_tflite(export_savedmodel(model, os.path.join(tmp_dir, "saved_model")), output_path)
+    # lets pred.py refuse an int8 file quantized from other weights
+    write_source_record(output_path, weights_path)
+
+    fp32_size = os.path.getsize(os.path.join(args.model_dir,"tf_model.h5"))
+    int8_size = os.path.getsize(output_path)
+    print(f"size: fp32 {fp32_size / 2**20:.1f} MB -> int8 {int8_size / 2**20:.1f} MB ({fp32_size / int8_size:.2f}x smaller)")
+
+    if args.eval_csv is not None: 
+        # same validation split and seqeval evaluation as eval_validateset.py
+        tf_val_dataset = eval_validateset.load_validation_dataset(args.eval_csv)
+        ner_labels = list(model.config.id2label.values())
+        fp32_results, fp32_time = timed_evaluate(model, tf_val_dataset, ner_labels)
+        int8_results, int8_time = timed_evaluate(model, tf_val_dataset, ner_labels, predict_fn=tflite_predict_fn(output_path))
+
+        for name in ['POI', 'STR']: 
+            print(f"{name} f1: fp32 {fp32_results[name]['f1']:.4f}  int8 {int8_results[name]['f1']:.4f}  "
+                  f"delta {int8_results[name]['f1'] - fp32_results[name]['f1']:+.4f}")
+        f1_delta = int8_results['overall_f1'] - fp32_results['overall_f1']
+        print(f"overall f1: fp32 {fp32_results['overall_f1']:.4f}  int8 {int8_results['overall_f1']:.4f}  delta {f1_delta:+.4f}")
+        print(f"validation time: fp32 {fp32_time:.1f}s  int8 {int8_time:.1f}s  ({fp32_time / int8_time:.2f}x speedup)")
+        if f1_delta < -args.max_f1_drop: 
+            raise SystemExit(f"int8 model loses {-f1_delta:.4f} overall F1, more than --max_f1_drop {args.max_f1_drop}")
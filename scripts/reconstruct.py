@@ -0,0 +1,152 @@
+import numpy as np
+
+# word-level tags, stored as small ints so a whole batch can be handled as one matrix
+TAGS = np.array(['O', 'POI', 'STR', 'POI/STR'])
+O, POI, STR, POI_STR = 0, 1, 2, 3
+
+# sub-word tags that count as a vote for POI / street (I- tags do not vote)
+POI_VOTE_TAGS = ['B-POI', 'E-POI', 'S-POI']
+STR_VOTE_TAGS = ['B-STR', 'E-STR', 'S-STR']
+
+
+def label_names(id2label):
+    """
+    id2label as an array indexed by label id, so a whole label matrix can be mapped in one lookup.
+    """
+    return np.array([id2label[i] for i in sorted(id2label, key=int)])
+
+
+def vote_tables(id2label):
+    """
+    Build lookup tables mapping a label id to whether it votes for POI / street.
+
+    Args:
+        - id2label: dict of label id -> IOBES tag, e.g. model.config.id2label
+    """
+    names = label_names(id2label)
+    return np.isin(names, POI_VOTE_TAGS), np.isin(names, STR_VOTE_TAGS)
+
+
+def argmax_labels(logits):
+    """
+    Predicted label id per sub-word, as int8 (int16 for more than 127 labels) instead of argmax's int64.
+    """
+    dtype = np.int8 if logits.shape[-1] <= np.iinfo(np.int8).max else np.int16
+    return np.argmax(logits, axis=-1).astype(dtype, copy=False)
+
+
+def batch_word_ids(tokenized_inputs):
+    """
+    Word ids of every row of a batched `tokenizer(..., is_split_into_words=True)` output, -1 for special tokens.
+    """
+    return [[-1 if i is None else i for i in tokenized_inputs.word_ids(batch_index = idx)]
+            for idx in range(len(tokenized_inputs['input_ids']))]
+
+
+def word_id_matrix(batch_wordid, attention_mask):
+    """
+    Scatter per-row word ids (-1 for special tokens) into the padded (rows, seq_len) batch, -1 for padding.
+    Rows must be right-padded, as DataCollatorForTokenClassification does, so one boolean mask places every row.
+    """
+    attention_mask = np.asarray(attention_mask).astype(bool)
+    wordid_matrix = np.full(attention_mask.shape, -1, dtype=np.int32)
+    if len(batch_wordid) > 0:
+        wordid_matrix[attention_mask] = np.concatenate(batch_wordid)
+    return wordid_matrix
+
+
+def vote_segments(labels, wordid_matrix, word_offsets, poi_table, str_table):
+    """
+    Flat word index of every POI / street vote in a batch, for tallying votes with one bincount.
+
+    Args:
+        - labels: (rows, seq_len) int matrix of predicted label ids
+        - wordid_matrix: (rows, seq_len) int matrix of word ids, -1 for special tokens and padding
+        - word_offsets: (rows,) index of each row's first word in the flat word array. Rows that are windows
+          of the same address share its offset, so their votes add up.
+        - poi_table, str_table: outputs of vote_tables
+
+    Returns:
+        (poi_segments, str_segments) int arrays, one entry per vote.
+    """
+    labels = np.asarray(labels)
+    wordid_matrix = np.asarray(wordid_matrix)
+    valid = wordid_matrix >= 0
+    segment = (np.asarray(word_offsets)[:, None] + wordid_matrix)[valid]
+    valid_labels = labels[valid]
+    return segment[poi_table[valid_labels]], segment[str_table[valid_labels]]
+
+
+def votes_to_tags(poi, street):
+    # word tag from POI / street vote counts: the majority wins, a tie with votes is POI_STR, no votes is O
+    tags = np.full(np.shape(poi), O, dtype=np.int8)
+    tags[poi > street] = POI
+    tags[street > poi] = STR
+    tags[(street == poi) & (poi > 0)] = POI_STR
+    return tags
+
+
+def ragged_to_matrix(flat, lengths, fill=O):
+    """
+    Lay out a flat array holding consecutive rows of the given lengths as a right-padded (rows, max length) matrix.
+    """
+    lengths = np.asarray(lengths)
+    matrix = np.full((len(lengths), max(int(lengths.max(initial=0)), 1)), fill, dtype=np.asarray(flat).dtype)
+    matrix[np.arange(matrix.shape[1]) < lengths[:, None]] = flat
+    return matrix
+
+
+# align label and compress sub-word tags into one tag per word, for a whole batch
+def compress_tag(labels, wordid_matrix, poi_table, str_table):
+    """
+    Args:
+        - labels: (rows, seq_len) int matrix of predicted label ids
+        - wordid_matrix: (rows, seq_len) int matrix of word ids, -1 for special tokens and padding
+        - poi_table, str_table: outputs of vote_tables
+
+    Returns:
+        (rows, n_words) int8 matrix of word tags (O, POI, STR, POI_STR); columns past a row's last word are O.
+    """
+    wordid_matrix = np.asarray(wordid_matrix)
+    n_rows = wordid_matrix.shape[0]
+    n_words = max(int(wordid_matrix.max(initial=-1)) + 1, 1)
+
+    # one segment per (row, word); count the POI/STR votes falling in each segment
+    poi_segments, str_segments = vote_segments(labels, wordid_matrix, np.arange(n_rows) * n_words, poi_table, str_table)
+    poi = np.bincount(poi_segments, minlength=n_rows * n_words).reshape(n_rows, n_words)
+    street = np.bincount(str_segments, minlength=n_rows * n_words).reshape(n_rows, n_words)
+    return votes_to_tags(poi, street)
+
+
+def _fill_span(tag_compressed, is_tag, tag):
+    # fill everything between the first and last occurrence, for rows with more than one occurrence
+    count = is_tag.sum(axis=1)
+    first = is_tag.argmax(axis=1)
+    last = is_tag.shape[1] - 1 - is_tag[:, ::-1].argmax(axis=1)
+    cols = np.arange(is_tag.shape[1])
+    span = (count > 1)[:, None] & (cols >= first[:, None]) & (cols <= last[:, None])
+    tag_compressed[span] = tag
+
+
+# reconstruct tag: make POI and street spans contiguous
+def recon_compress_tag(tag_compressed):
+    tag_compressed = np.array(tag_compressed, dtype=np.int8)
+    is_poi = tag_compressed == POI
+    is_street = tag_compressed == STR
+    _fill_span(tag_compressed, is_poi, POI)
+    _fill_span(tag_compressed, is_street, STR)
+    return tag_compressed
+
+
+def split_elements(words, tags):
+    """
+    Split the words of one address into (street, poi) word lists using its compressed tags.
+    `words` should be the cleaned input tokens the word ids refer to, so the spans come out verbatim.
+    """
+    street, poi = [], []
+    for word, tag in zip(words, tags):
+        if tag == POI or tag == POI_STR:
+            poi.append(word)
+        elif tag == STR:
+            street.append(word)
+    return street, poi
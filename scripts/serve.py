@@ -0,0 +1,223 @@
+import json, time, queue, threading
+import argparse
+from collections import Counter, deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from pred import AddressElementExtract, DEFAULT_MODEL_DIR
+from instrumentation import PipelineMetrics, MetricsExporter, SlowRequestProfiler
+
+
+class ServerMetrics():
+    """
+    Request latencies (most recent `window` requests) and a histogram of micro-batch sizes.
+    """
+
+    def __init__(self, window=10000):
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=window)
+        self._batch_sizes = Counter()
+        self.requests = 0
+        self.errors = 0
+
+    def record_request(self, seconds, ok=True):
+        with self._lock:
+            self._latencies.append(seconds)
+            self.requests += 1
+            self.errors += 0 if ok else 1
+
+    def record_batch(self, size):
+        with self._lock:
+            self._batch_sizes[size] += 1
+
+    def snapshot(self):
+        with self._lock:
+            latencies_ms = np.array(self._latencies) * 1e3
+            batch_sizes = dict(sorted(self._batch_sizes.items()))
+            requests, errors = self.requests, self.errors
+        latency = {}
+        if len(latencies_ms) > 0:
+            latency = {"p50": float(np.percentile(latencies_ms, 50)), "p99": float(np.percentile(latencies_ms, 99)),
+                       "mean": float(latencies_ms.mean())}
+        return {"requests": requests, "errors": errors, "latency_ms": latency,
+                "batch_size_histogram": {str(size): count for size, count in batch_sizes.items()}}
+
+
+class MicroBatcher():
+    """
+    Collect addresses submitted from many request threads into micro-batches for one `extract_fn` call each.
+
+    A batch is closed when it holds `max_batch_size` addresses or `max_wait_ms` after its first address arrived,
+    whichever comes first. `extract_fn` takes a list of raw addresses and returns one {street, poi} per address.
+    If it raises, the batch is bisected and retried, so an address that fails only fails its own request.
+    """
+
+    def __init__(self, extract_fn, max_batch_size=64, max_wait_ms=5, metrics=None):
+        self.extract_fn = extract_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1e3
+        self.metrics = metrics
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, address):
+        future = Future()
+        self._queue.put((address, future))
+        return future
+
+    def _next_batch(self):
+        # block for the first address, then wait at most max_wait for the rest of the batch
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _extract(self, batch):
+        try:
+            elements = self.extract_fn([address for address, _ in batch])
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+                return
+            # split the failed batch and retry the halves, so only the requests whose address fails get the error
+            middle = len(batch) // 2
+            self._extract(batch[:middle])
+            self._extract(batch[middle:])
+            return
+        for (_, future), element in zip(batch, elements):
+            future.set_result(element)
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if self.metrics is not None:
+                self.metrics.record_batch(len(batch))
+            self._extract(batch)
+
+
+class ExtractHandler(BaseHTTPRequestHandler):
+    # POST /extract {"address": "..."} -> {"street": "...", "poi": "..."};  GET /metrics -> latency and batch-size stats,
+    # plus the extractor's per-stage timings and counters if enabled, also as Prometheus text on GET /metrics/prometheus
+
+    def _send(self, status, payload, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _send_json(self, status, body):
+        self._send(status, json.dumps(body).encode("utf-8"), "application/json")
+
+    def do_GET(self):
+        pipeline_metrics = self.server.pipeline_metrics
+        if self.path == "/metrics":
+            body = self.server.metrics.snapshot()
+            if pipeline_metrics is not None:
+                body["pipeline"] = pipeline_metrics.snapshot()
+            self._send_json(200, body)
+        elif self.path == "/metrics/prometheus" and pipeline_metrics is not None:
+            self._send(200, pipeline_metrics.to_prometheus().encode("utf-8"), "text/plain; version=0.0.4")
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path != "/extract":
+            self._send_json(404, {"error": "not found"})
+            return
+        start_time = time.perf_counter()
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            address = body["address"]
+            if not isinstance(address, str):
+                raise TypeError("address must be a string")
+        except (ValueError, KeyError, TypeError) as e:
+            self._send_json(400, {"error": f"expected a JSON body like {{\"address\": \"...\"}}: {e}"})
+            return
+
+        try:
+            element = self.server.batcher.submit(address).result()
+        except Exception as e:
+            self.server.metrics.record_request(time.perf_counter() - start_time, ok=False)
+            self._send_json(500, {"error": str(e)})
+            return
+        self.server.metrics.record_request(time.perf_counter() - start_time)
+        self._send_json(200, element)
+
+    def log_message(self, format, *args):
+        # one line per request would swamp the console under load
+        pass
+
+
+class ExtractServer(ThreadingHTTPServer):
+    # the default listen backlog of 5 resets connections as soon as a few dozen clients connect at once
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+def make_server(extract_fn, host="127.0.0.1", port=8000, max_batch_size=64, max_wait_ms=5, pipeline_metrics=None):
+    server = ExtractServer((host, port), ExtractHandler)
+    server.metrics = ServerMetrics()
+    server.pipeline_metrics = pipeline_metrics
+    server.batcher = MicroBatcher(extract_fn, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms, metrics=server.metrics)
+    return server
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Serve street/POI extraction over HTTP with micro-batching')
+    parser.add_argument('--model_dir', default=DEFAULT_MODEL_DIR, help='fine-tuned model directory or exported bundle')
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max_batch_size', type=int, default=64, help='max addresses per forward pass')
+    parser.add_argument('--max_wait_ms', type=float, default=5, help='max time a request waits for its batch to fill')
+    parser.add_argument('--cache_size', type=int, default=0, help='cache this many extracted addresses; 0 disables the cache')
+    parser.add_argument('--cache_path', default=None, help='sqlite file to persist the cache across restarts')
+    parser.add_argument('--tflite', action='store_true', help='run the int8 model_int8.tflite written by quantize_tflite.py')
+    parser.add_argument('--expand_abbreviations', action='store_true', help='expand abbreviated words with <model_dir>/abbreviations.npz')
+    parser.add_argument('--max_length', type=int, default=None, 
+                        help='max sub-words per sequence (e.g. 64 or 128); longer addresses are split into overlapping windows')
+    parser.add_argument('--window_overlap', type=int, default=16, help='sub-words shared by consecutive windows')
+    parser.add_argument('--pipeline_metrics', action='store_true', help='time every pipeline stage and count rows/tokens/padding')
+    parser.add_argument('--metrics_file', default=None, help='also write the pipeline metrics to this file (implies --pipeline_metrics)')
+    parser.add_argument('--metrics_url', default=None, help='also POST the pipeline metrics to this endpoint (implies --pipeline_metrics)')
+    parser.add_argument('--metrics_format', default="prometheus", choices=["prometheus", "jsonl"])
+    parser.add_argument('--metrics_interval', type=float, default=15, help='seconds between metrics exports')
+    parser.add_argument('--profile_dir', default=None, help='profile requests and dump the slowest ones here on shutdown')
+    parser.add_argument('--profile_slowest', type=int, default=10, help='number of slowest micro-batches to keep profiles of')
+    parser.add_argument('--profile_sample_rate', type=float, default=0.1, help='share of micro-batches to profile')
+    args = parser.parse_args()
+
+    pipeline_metrics, exporter, profiler = None, None, None
+    if args.pipeline_metrics or args.metrics_file or args.metrics_url:
+        pipeline_metrics = PipelineMetrics()
+    if args.metrics_file or args.metrics_url:
+        exporter = MetricsExporter(pipeline_metrics, path=args.metrics_file, url=args.metrics_url, 
+                                   format=args.metrics_format, interval=args.metrics_interval)
+    if args.profile_dir is not None:
+        profiler = SlowRequestProfiler(args.profile_dir, n_slowest=args.profile_slowest, sample_rate=args.profile_sample_rate)
+
+    extractor = AddressElementExtract(args.model_dir, result_cache_size=args.cache_size, result_cache_path=args.cache_path, 
+                                      use_tflite=args.tflite, expand_abbreviations=args.expand_abbreviations, warmup=True, 
+                                      metrics=pipeline_metrics, profiler=profiler, 
+                                      max_length=args.max_length, window_overlap=args.window_overlap)
+    server = make_server(lambda addresses: extractor.extract_elements(addresses, batch_size=args.max_batch_size),
+                         args.host, args.port, args.max_batch_size, args.max_wait_ms, pipeline_metrics=pipeline_metrics)
+    print(f"serving on http://{args.host}:{args.port} (POST /extract, GET /metrics)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+    finally:
+        if exporter is not None:
+            exporter.close()
+        if profiler is not None:
+            print(f"profiles of the slowest requests: {profiler.dump()}")
@@ -0,0 +1,160 @@
+import numpy as np
+import pytest
+from reconstruct import (TAGS, O, label_names, vote_tables, word_id_matrix, vote_segments, votes_to_tags, ragged_to_matrix,
+                         compress_tag, recon_compress_tag)
+from batching import window_rows
+
+# Equivalence of the vectorized word-tag reconstruction with the original per-row, string-based one.
+ID2LABEL = {0: 'B-POI', 1: 'B-STR', 2: 'E-POI', 3: 'E-STR', 4: 'I-POI', 5: 'I-STR', 6: 'S-POI', 7: 'S-STR', 8: 'O'}
+LABEL2ID = {label: i for i, label in ID2LABEL.items()}
+NAMES = label_names(ID2LABEL)
+POI_TABLE, STR_TABLE = vote_tables(ID2LABEL)
+
+
+# reference: compress_tag and recon_compress_tag of the original pred_test.py, verbatim
+def reference_compress_tag(masked_labels, wordid):
+    tag_compressed = []
+    for id in range(0, np.max([i for i in wordid if i is not None])+1):
+
+        # idx associated with the same word (across potentially multiple tokens)
+        id_idx = np.where(np.asarray(wordid) == id)[0]
+        id_tag = np.asarray(masked_labels)[id_idx]
+
+        # compress tag
+        poi = 0
+        street = 0
+        for t in id_tag:
+            if t in ['B-POI','E-POI','S-POI','S-POI']:
+                poi+= 1
+            elif t in ['B-STR','E-STR','S-STR','S-STR']:
+                street+= 1
+        if poi == 0 and street == 0:
+            tag_compressed.append("O")
+        elif poi > street:
+            tag_compressed.append('POI')
+        elif street > poi:
+            tag_compressed.append('STR')
+        elif street == poi: # street = poi != 0
+            tag_compressed.append('POI/STR')
+    return tag_compressed
+
+def reference_recon_compress_tag(tag_compressed):
+
+    poi_idx = np.where(np.array(tag_compressed) == "POI")[0]
+    street_idx = np.where(np.array(tag_compressed) == "STR")[0]
+    if len(poi_idx) > 1:
+        for i in range(poi_idx[0], poi_idx[-1]+1):
+            tag_compressed[i] = "POI"
+    if len(street_idx) > 1:
+        for i in range(street_idx[0], street_idx[-1]+1):
+            tag_compressed[i] = "STR"
+
+    return tag_compressed
+
+
+def random_batch(rng, label_choices=None, max_rows=20, max_len=30):
+    # right-padded label matrix plus per-row word ids: [CLS], words of one or more sub-words in order, [SEP]
+    n_rows, seq_len = rng.integers(1, max_rows + 1), rng.integers(3, max_len + 1)
+    label_choices = np.arange(len(ID2LABEL)) if label_choices is None else label_choices
+    labels = rng.choice(label_choices, (n_rows, seq_len)).astype(np.int8)
+    mask = np.zeros((n_rows, seq_len), dtype=np.int32)
+    batch_wordid = []
+    for row in range(n_rows):
+        length = rng.integers(3, seq_len + 1)
+        n_words = rng.integers(1, length - 1)
+        inner = np.sort(np.concatenate([np.arange(n_words), rng.integers(0, n_words, length - 2 - n_words)]))
+        batch_wordid.append([-1] + inner.tolist() + [-1])
+        mask[row, :length] = 1
+    return labels, batch_wordid, mask
+
+
+def reference_tags(labels, batch_wordid):
+    return [reference_recon_compress_tag(reference_compress_tag(NAMES[row_labels[:len(wordid)]],
+                                                                [None if w < 0 else w for w in wordid]))
+            for row_labels, wordid in zip(labels, batch_wordid)]
+
+
+def assert_matches_reference(tags, labels, batch_wordid):
+    for row_tags, expected in zip(tags, reference_tags(labels, batch_wordid)):
+        assert TAGS[row_tags[:len(expected)]].tolist() == expected
+        # columns past the row's last word are O
+        assert (row_tags[len(expected):] == O).all()
+
+
+@pytest.mark.parametrize("label_choices", [
+    None,
+    # mostly O, only voting tags
+    [LABEL2ID[t] for t in ['B-POI', 'B-STR', 'E-POI', 'E-STR', 'O', 'O', 'O']],
+    # I- tags do not vote: words made only of them are O
+    [LABEL2ID[t] for t in ['I-POI', 'I-STR', 'O', 'S-POI']],
+    # POI and street votes only, so multi-sub-word words often tie
+    [LABEL2ID[t] for t in ['S-POI', 'S-STR']],
+])
+def test_compress_tag_matches_reference(label_choices):
+    rng = np.random.default_rng(0)
+    for _ in range(300):
+        labels, batch_wordid, mask = random_batch(rng, label_choices)
+        tags = recon_compress_tag(compress_tag(labels, word_id_matrix(batch_wordid, mask), POI_TABLE, STR_TABLE))
+        assert_matches_reference(tags, labels, batch_wordid)
+
+
+def test_i_tags_do_not_vote():
+    labels = np.array([[8, LABEL2ID['I-POI'], LABEL2ID['I-STR'], LABEL2ID['I-POI'], 8]])
+    tags = compress_tag(labels, word_id_matrix([[-1, 0, 1, 1, -1]], np.ones_like(labels)), POI_TABLE, STR_TABLE)
+    assert TAGS[tags[0]].tolist() == ['O', 'O']
+
+
+def test_tie_is_poi_str():
+    labels = np.array([[8, LABEL2ID['B-POI'], LABEL2ID['E-STR'], LABEL2ID['I-POI'], 8]])
+    tags = compress_tag(labels, word_id_matrix([[-1, 0, 0, 0, -1]], np.ones_like(labels)), POI_TABLE, STR_TABLE)
+    assert TAGS[tags[0]].tolist() == ['POI/STR']
+
+
+def test_padding_and_rows_without_words():
+    # second row is only [CLS] [SEP]; the original code can't handle it (max of an empty list), it gets no tags
+    labels = np.array([[8, LABEL2ID['S-POI'], 8, LABEL2ID['S-POI'], 8],
+                       [LABEL2ID['S-POI'], LABEL2ID['S-STR'], LABEL2ID['S-POI'], LABEL2ID['S-STR'], 8]])
+    mask = np.array([[1, 1, 1, 1, 1], [1, 1, 0, 0, 0]])
+    tags = recon_compress_tag(compress_tag(labels, word_id_matrix([[-1, 0, 1, 2, -1], [-1, -1]], mask), POI_TABLE, STR_TABLE))
+    assert TAGS[tags[0]].tolist() == ['POI', 'POI', 'POI']
+    assert (tags[1] == O).all()
+    # a batch of rows without words still has one (O) column
+    tags = compress_tag(labels[1:, :2], word_id_matrix([[-1, -1]], mask[1:, :2]), POI_TABLE, STR_TABLE)
+    assert tags.shape == (1, 1) and tags[0, 0] == O
+
+
+@pytest.mark.parametrize("max_length, overlap", [(5, 0), (6, 2), (8, 3), (12, 6)])
+def test_windowed_votes_match_unwindowed(max_length, overlap):
+    # votes of overlapping windows of the same address are merged per word, as AddressElementExtract does;
+    # a sub-word seen by two windows votes twice, which doubles both counts and leaves the word's tag unchanged
+    rng = np.random.default_rng(1)
+    for _ in range(200):
+        labels, batch_wordid, mask = random_batch(rng, max_len=40)
+        expected = recon_compress_tag(compress_tag(labels, word_id_matrix(batch_wordid, mask), POI_TABLE, STR_TABLE))
+
+        # window "input ids" are sub-word positions, so each window's labels can be looked up in its row
+        positions = [list(range(len(wordid))) for wordid in batch_wordid]
+        window_pos, window_wordid, window_row = window_rows(positions, batch_wordid, max_length, overlap)
+        assert max(len(ids) for ids in window_pos) <= max_length
+        window_labels = [labels[row, pos] for row, pos in zip(window_row, window_pos)]
+        window_mask = np.zeros((len(window_pos), max(len(ids) for ids in window_pos)), dtype=np.int32)
+        padded_labels = np.full(window_mask.shape, LABEL2ID['O'], dtype=np.int8)
+        for i, row_labels in enumerate(window_labels):
+            window_mask[i, :len(row_labels)] = 1
+            padded_labels[i, :len(row_labels)] = row_labels
+
+        n_words = np.array([max(wordid) + 1 for wordid in batch_wordid], dtype=np.int64)
+        word_offsets = np.concatenate([[0], np.cumsum(n_words)[:-1]])
+        # one batch per window, as with batch_size=1
+        segments = [vote_segments(padded_labels[i:i + 1], word_id_matrix(window_wordid[i:i + 1], window_mask[i:i + 1]),
+                                  word_offsets[window_row[i:i + 1]], POI_TABLE, STR_TABLE)
+                    for i in range(len(window_pos))]
+        poi = np.bincount(np.concatenate([s[0] for s in segments]), minlength=n_words.sum())
+        street = np.bincount(np.concatenate([s[1] for s in segments]), minlength=n_words.sum())
+        tags = recon_compress_tag(ragged_to_matrix(votes_to_tags(poi, street), n_words))
+
+        assert tags.shape[0] == expected.shape[0]
+        width = min(tags.shape[1], expected.shape[1])
+        assert (tags[:, :width] == expected[:, :width]).all()
+        assert (tags[:, width:] == O).all() and (expected[:, width:] == O).all()
+        assert_matches_reference(tags, labels, batch_wordid)